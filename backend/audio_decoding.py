@@ -0,0 +1,63 @@
+import os
+import subprocess
+import tempfile
+import numpy as np
+
+# --- 音訊解碼 ---
+# 直接以 ffmpeg 子程序把上傳的 bytes 解碼成模型需要的 16kHz 單聲道 float32，
+# 取代原本「寫暫存檔 -> pydub 轉 .wav -> librosa 讀回 -> 再重新取樣」的流程。
+FFMPEG_BINARY = os.getenv("FFMPEG_BINARY", "ffmpeg")
+TARGET_SAMPLING_RATE = 16000
+
+
+def _ffmpeg_decode_command(input_path: str, target_sr: int) -> list:
+    return [
+        FFMPEG_BINARY,
+        "-nostdin",
+        "-loglevel", "error",
+        "-i", input_path,
+        "-f", "f32le",
+        "-acodec", "pcm_f32le",
+        "-ac", "1",
+        "-ar", str(target_sr),
+        "pipe:1",
+    ]
+
+
+def decode_audio_bytes(audio_bytes: bytes, target_sr: int = TARGET_SAMPLING_RATE) -> np.ndarray:
+    """
+    將上傳的音訊 bytes (webm / wav / mp3 / ogg ...) 解碼為 target_sr 單聲道 float32 陣列。
+    音訊經由 stdin/stdout 管線傳遞，不落地。
+    """
+    proc = subprocess.run(
+        _ffmpeg_decode_command("pipe:0", target_sr),
+        input=audio_bytes,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    if proc.returncode != 0 or not proc.stdout:
+        # mp4/m4a 等 moov 在檔尾的容器無法從管線讀取 (需要 seek)，只有這種情況才退回暫存檔
+        with tempfile.NamedTemporaryFile(suffix=".input") as temp_in:
+            temp_in.write(audio_bytes)
+            temp_in.flush()
+            proc = subprocess.run(
+                _ffmpeg_decode_command(temp_in.name, target_sr),
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to decode audio: {proc.stderr.decode(errors='replace').strip()}")
+
+    audio_array = np.frombuffer(proc.stdout, dtype=np.float32)
+    if audio_array.size == 0:
+        raise ValueError("Decoded audio is empty.")
+    return audio_array
+
+
+def preprocess_audio(audio_bytes: bytes, target_sr: int = TARGET_SAMPLING_RATE) -> np.ndarray:
+    """
+    解碼並正規化到 [-1, 1] (與 prepare_audio 相同)，在 Worker 的前處理 process pool 中執行。
+    """
+    audio_array = decode_audio_bytes(audio_bytes, target_sr=target_sr)
+    peak = np.max(np.abs(audio_array))
+    return audio_array / peak if peak > 0 else audio_array
@@ -0,0 +1,84 @@
+import math
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+# --- 批次組成 ---
+# Whisper 的 encoder 固定吃 30 秒的輸入，真正隨批次變動的成本是「填充後」的長度：
+#   有 prompt：batch_size * 最長 prompt 的 token 數 (decoder 長度)
+#   無 prompt：batch_size * 最長音檔秒數 (解碼步數依音檔長度估算)
+# 所以先把長度相近的項目排在一起，再依預算切成批次。
+@dataclass
+class BatchLimits:
+    max_batch_size: int = 16
+    max_audio_seconds: float = 240.0  # 無 prompt 批次：batch_size * 最長音檔秒數
+    max_prompt_tokens: int = 1024  # 有 prompt 批次：batch_size * 最長 prompt token 數
+    max_wait_seconds: float = 0.5  # 最舊的項目最多等待多久就必須送出
+
+
+def estimate_prompt_tokens(prompt_text: Optional[str]) -> int:
+    """
+    不載入 tokenizer 的情況下估計 prompt 的 token 數 (每個單字約 1.3 個 token，加上特殊 token)。
+    """
+    if not prompt_text:
+        return 0
+    return int(math.ceil(len(prompt_text.split()) * 1.3)) + 3
+
+
+def _padded_cost(batch: List[Dict], key: str) -> float:
+    return len(batch) * max(item[key] for item in batch)
+
+
+def form_batches(items: List[Dict], limits: BatchLimits) -> List[List[Dict]]:
+    """
+    將項目分組成批次。每個項目需有 "duration" (秒) 與 "prompt_text"。
+    有 prompt 與無 prompt 的項目不會放在同一批 (兩者走不同的推論路徑)。
+    單一項目即使超過預算也會自成一批。
+    """
+    with_prompt = []
+    without_prompt = []
+    for item in items:
+        if item.get("prompt_text"):
+            item.setdefault("prompt_tokens", estimate_prompt_tokens(item["prompt_text"]))
+            with_prompt.append(item)
+        else:
+            without_prompt.append(item)
+
+    batches = []
+    for group, cost_key, budget in (
+        (with_prompt, "prompt_tokens", limits.max_prompt_tokens),
+        (without_prompt, "duration", limits.max_audio_seconds),
+    ):
+        # 依長度排序，讓長度相近的項目落在同一批，減少填充
+        group = sorted(group, key=lambda x: (x.get("prompt_tokens", 0), x["duration"]))
+        current = []
+        for item in group:
+            candidate = current + [item]
+            if current and (
+                len(candidate) > limits.max_batch_size
+                or _padded_cost(candidate, cost_key) > budget
+            ):
+                batches.append(current)
+                candidate = [item]
+            current = candidate
+        if current:
+            batches.append(current)
+    return batches
+
+
+def should_dispatch(
+    queue_length: int,
+    oldest_enqueued_at: Optional[float],
+    limits: BatchLimits,
+    now: Optional[float] = None,
+) -> bool:
+    """
+    佇列中的項目足以填滿一個批次，或最舊的項目已等待超過 max_wait_seconds 時才送出。
+    """
+    if queue_length == 0:
+        return False
+    if queue_length >= limits.max_batch_size or oldest_enqueued_at is None:
+        return True
+    now = time.time() if now is None else now
+    return now - oldest_enqueued_at >= limits.max_wait_seconds
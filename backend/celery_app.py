@@ -0,0 +1,30 @@
+import os
+from celery import Celery
+
+# 只包含 Celery 的設定，讓 API 行程 (main.py) 不必匯入 torch / transformers / whistress。
+# 模型與批次消費迴圈定義在 tasks.py，只在 Worker 中載入。
+
+# --- Celery 配置 ---
+# BROKER_URL 指向你的 Redis 服務
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
+# RESULT_BACKEND 用於儲存任務結果，也指向 Redis
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+
+celery_app = Celery(
+    'whistress_tasks',
+    broker=CELERY_BROKER_URL,
+    backend=CELERY_RESULT_BACKEND
+)
+
+# Celery 配置的更動
+celery_app.conf.update(
+    task_serializer='pickle', # 支持 bytes 數據傳輸
+    accept_content=['json', 'pickle'],
+    result_serializer='json', # 結果序列化為 JSON
+    timezone='Asia/Taipei',
+    enable_utc=True,
+    worker_prefetch_multiplier=1, # 確保 Worker 不會預先抓取太多任務
+    task_time_limit=3600, # 任務時間限制
+    task_soft_time_limit=3000, # 軟時間限制
+    # 批次處理不再由 Celery Beat 定期觸發，改由 Worker 內的消費迴圈 (batch_consumer_loop) 阻塞等待佇列
+)
@@ -0,0 +1,161 @@
+import argparse
+import io
+import sys
+import time
+from pathlib import Path
+import torch
+from audio_decoding import preprocess_audio, TARGET_SAMPLING_RATE
+from whistress import WhiStressInferenceClient
+
+# 比較 fp32 模型與另一種推論模式 (例如 int8 量化、bf16 或 ONNX Runtime 引擎) 在一組測試音訊上的結果：
+#   - 不給 prompt：轉錄完全相同的比例，以及轉錄相同時逐字的 stress 一致率
+#   - 給 prompt (同名 .txt 檔，沒有則用 fp32 的轉錄)：逐字的 stress 一致率與以 fp32 為基準的 F1
+# 並回報兩者的吞吐量與模型大小。
+#
+# 用法: python backend/check_agreement.py FIXTURE_DIR --quantization int8 [--quantize-head]
+#       python backend/check_agreement.py FIXTURE_DIR --precision bf16
+#       python backend/check_agreement.py FIXTURE_DIR --engine onnx
+# FIXTURE_DIR 中每個音訊檔是一筆測試資料，例如:
+# ```
+# fixtures/
+# ├── clip01.wav
+# ├── clip01.txt   <- 可省略，作為 prompt
+# └── clip02.m4a
+# ```
+# prompt 模式的一致率低於 --min-agreement 時以 exit code 1 結束。
+
+AUDIO_EXTENSIONS = {".wav", ".mp3", ".m4a", ".webm", ".ogg", ".flac"}
+
+
+def load_fixtures(fixture_dir: Path) -> list:
+    fixtures = []
+    for path in sorted(fixture_dir.iterdir()):
+        if path.suffix.lower() not in AUDIO_EXTENSIONS:
+            continue
+        prompt_path = path.with_suffix(".txt")
+        prompt = prompt_path.read_text(encoding="utf-8").strip() if prompt_path.exists() else ""
+        fixtures.append({
+            "name": path.name,
+            "audio": {"array": preprocess_audio(path.read_bytes()), "sampling_rate": TARGET_SAMPLING_RATE},
+            "prompt": prompt or None,
+        })
+    return fixtures
+
+
+def run_batches(client, audio_list: list, prompts, batch_size: int):
+    """
+    依 batch_size 分批推論，回傳 ([(transcription, stresses), ...], 秒數)。
+    """
+    results = []
+    started_at = time.perf_counter()
+    for i in range(0, len(audio_list), batch_size):
+        results.extend(client.predict_batch(
+            audio_list[i:i + batch_size],
+            prompts[i:i + batch_size] if prompts is not None else None,
+            return_pairs=False,
+            audio_prepared=True,
+        ))
+    return results, time.perf_counter() - started_at
+
+
+def stress_agreement(reference: list, candidate: list):
+    """
+    逐字比較 stress 標記 (只比較轉錄相同的片段)，回傳 (一致的字數, 總字數, 以 reference 為基準的 F1)。
+    """
+    agreed = total = true_positive = reference_positive = candidate_positive = 0
+    for (ref_text, ref_stresses), (cand_text, cand_stresses) in zip(reference, candidate):
+        if ref_text != cand_text:
+            continue
+        for ref, cand in zip(ref_stresses, cand_stresses):
+            agreed += ref == cand
+            total += 1
+            true_positive += ref == 1 and cand == 1
+            reference_positive += ref == 1
+            candidate_positive += cand == 1
+    f1 = 2 * true_positive / (reference_positive + candidate_positive) if reference_positive + candidate_positive else 1.0
+    return agreed, total, f1
+
+
+def model_size_mb(client) -> float:
+    if not hasattr(client, "whistress"):
+        # ONNX Runtime 引擎：匯出的 graph 檔案大小
+        return sum(path.stat().st_size for path in client.onnx_dir.glob("*.onnx")) / 1e6
+    # 以序列化後的大小估算 (量化後的權重不在 parameters() 中)
+    buffer = io.BytesIO()
+    torch.save(client.whistress.state_dict(), buffer)
+    return buffer.tell() / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check stress agreement of a reduced-cost inference mode against fp32.")
+    parser.add_argument("fixture_dir", type=Path)
+    parser.add_argument("--engine", choices=["torch", "onnx"], default="torch")
+    parser.add_argument("--quantization", choices=["int8"], default=None)
+    parser.add_argument("--quantize-head", action="store_true")
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--threads", type=int, default=None, help="torch threads for both models")
+    parser.add_argument("--min-agreement", type=float, default=0.98)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    fixtures = load_fixtures(args.fixture_dir)
+    if not fixtures:
+        sys.exit(f"No audio files found in {args.fixture_dir}")
+    audio_list = [fixture["audio"] for fixture in fixtures]
+    print(f"Loaded {len(fixtures)} fixtures from {args.fixture_dir}")
+
+    candidate_options = {
+        "quantization": args.quantization, "quantize_head": args.quantize_head, "precision": args.precision,
+    }
+    clients = {"fp32": WhiStressInferenceClient(device=args.device, encoder_cache_size=0)}
+    if args.engine == "onnx":
+        from whistress import WhiStressOnnxClient
+        candidate_options = {"engine": "onnx"}
+        clients["candidate"] = WhiStressOnnxClient(intra_op_num_threads=args.threads)
+    else:
+        clients["candidate"] = WhiStressInferenceClient(device=args.device, encoder_cache_size=0, **candidate_options)
+
+    outputs = {}
+    for name, client in clients.items():
+        # 第一個批次不計時 (一次性的初始化成本)
+        run_batches(client, audio_list[:args.batch_size], None, args.batch_size)
+        free, free_seconds = run_batches(client, audio_list, None, args.batch_size)
+        outputs[name] = {"free": free, "seconds": free_seconds}
+
+    # prompt 模式：沒有 .txt 的片段使用 fp32 的轉錄，兩邊逐字對齊
+    prompts = [
+        fixture["prompt"] or text for fixture, (text, _) in zip(fixtures, outputs["fp32"]["free"])
+    ]
+    for name, client in clients.items():
+        prompted, prompted_seconds = run_batches(client, audio_list, prompts, args.batch_size)
+        outputs[name].update(prompted=prompted, seconds=outputs[name]["seconds"] + prompted_seconds)
+
+    reference, candidate = outputs["fp32"], outputs["candidate"]
+    transcript_matches = sum(ref[0] == cand[0] for ref, cand in zip(reference["free"], candidate["free"]))
+    free_agreed, free_total, free_f1 = stress_agreement(reference["free"], candidate["free"])
+    prompted_agreed, prompted_total, prompted_f1 = stress_agreement(reference["prompted"], candidate["prompted"])
+    prompted_agreement = prompted_agreed / prompted_total if prompted_total else 1.0
+
+    print(f"\nCandidate mode: {candidate_options}")
+    print(f"Transcripts identical (no prompt): {transcript_matches}/{len(fixtures)}")
+    if free_total:
+        print(f"Word stress agreement (no prompt, identical transcripts): {free_agreed / free_total:.4f} ({free_agreed}/{free_total}), F1 {free_f1:.4f}")
+    print(f"Word stress agreement (prompted): {prompted_agreement:.4f} ({prompted_agreed}/{prompted_total}), F1 {prompted_f1:.4f}")
+    for name, client in clients.items():
+        clips_per_second = 2 * len(fixtures) / outputs[name]["seconds"]
+        print(f"{name:>9}: {clips_per_second:.2f} clips/s, model size {model_size_mb(client):.0f} MB")
+    print(f"Speedup: {reference['seconds'] / candidate['seconds']:.2f}x")
+
+    for fixture, ref, cand in zip(fixtures, reference["prompted"], candidate["prompted"]):
+        if ref != cand:
+            print(f"  differs: {fixture['name']}: fp32 {ref[1]} vs candidate {cand[1]}")
+
+    if prompted_agreement < args.min_agreement:
+        sys.exit(f"Agreement {prompted_agreement:.4f} is below {args.min_agreement}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+from whistress.inference_client.utils import get_loaded_model, get_model_fingerprint, variant_fingerprint
+from whistress.inference_client.onnx_client import PATH_TO_ONNX_MODEL
+from whistress.model.onnx_export import export_onnx
+
+# 匯出 ONNX Runtime 推論引擎 (WHISTRESS_ENGINE=onnx) 使用的四個 graph：
+# Whisper encoder、含 KV cache 的 decoder (輸出 layer_for_head 的 hidden states)、stress head，
+# 與評分 prompt 用的 scorer (decoder 只跑到 layer_for_head，接著 stress head，不計算詞彙 logits)，
+# 以及 tokenizer / feature extractor 設定與貪婪解碼所需的生成參數。
+# 需要先下載權重 (或執行 pack_weights.py)，匯出時需要 torch、onnx 與 onnxruntime，執行時只需要 onnxruntime。
+#
+# 用法: python backend/export_onnx.py
+# Expected dir structure:
+# ```
+# whistress/
+# ├── weights/
+# │   └── ...
+# │   └── onnx/            <- 產生的目錄
+# │       └── encoder.onnx
+# │       └── decoder.onnx
+# │       └── head.onnx
+# │       └── scorer.onnx
+# │       └── whistress_onnx.json
+# ```
+
+model = get_loaded_model("cpu")
+# ONNX Runtime 的數值與 PyTorch 有些微差異，使用獨立的指紋，不共用快取結果
+model_fingerprint = variant_fingerprint(get_model_fingerprint(model), engine="onnx")
+export_onnx(model, PATH_TO_ONNX_MODEL, model_fingerprint=model_fingerprint)
+print(f"✅ ONNX model exported to {PATH_TO_ONNX_MODEL}")
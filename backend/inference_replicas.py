@@ -0,0 +1,307 @@
+import multiprocessing
+import multiprocessing.connection
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+import numpy as np
+from audio_decoding import TARGET_SAMPLING_RATE
+
+# --- 同一台機器上的多個推論 replica ---
+# 每個 replica 是一個獨立的 process，有自己的推論執行緒數 (torch.set_num_threads 或 ONNX Runtime 的 intra_op_num_threads)。
+# 權重以 pack_weights.py 產生的 safetensors 檔案 memory map 載入時，所有 replica 共用同一份實體記憶體。
+# 每個 replica 對應一條分派執行緒，閒置的執行緒從共用的佇列取下一個批次，所以批次總是交給閒置的 replica。
+
+WARMUP_PROMPT = "this is a warm up sentence"
+INFERENCE_ENGINES = ("torch", "onnx")
+
+
+def create_inference_client(engine: str = "torch", num_threads: Optional[int] = None, client_options: Optional[dict] = None):
+    """
+    建立推論客戶端。engine="onnx" 使用 export_onnx.py 匯出的 ONNX Runtime graph，不需要 torch；
+    client_options (例如 quantization) 只適用於 torch。
+    """
+    client_options = client_options or {}
+    if engine == "onnx":
+        if any(client_options.values()):
+            raise ValueError(f"Client options {client_options} only apply to the torch engine.")
+        from whistress.inference_client.onnx_client import WhiStressOnnxClient
+        return WhiStressOnnxClient(intra_op_num_threads=num_threads)
+    if engine != "torch":
+        raise ValueError(f"Unknown inference engine {engine!r}, expected one of {INFERENCE_ENGINES}")
+    import torch
+    from whistress import WhiStressInferenceClient
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return WhiStressInferenceClient(device=device, **client_options)
+
+
+def compile_static_shapes(client):
+    """
+    使用 torch.compile 路徑時 (WHISTRESS_COMPILE)，在接收請求前為每個 (batch, length) bucket 編譯 graph。
+    不論是否設定了暖機批次都要執行，否則每個 bucket 會在真正的請求中才編譯。
+    """
+    static_shapes = getattr(client, "static_shapes", None)
+    if static_shapes is None:
+        return
+    started_at = time.time()
+    try:
+        client.compile_buckets()
+        print(f"Compiled {len(static_shapes.batch_buckets)}x{len(static_shapes.length_buckets)} shape buckets in {time.time() - started_at:.2f}s.")
+    except Exception as e:
+        # 例如沒有 C++ 編譯器：改回 eager 模式，而不是讓之後每個請求都失敗
+        print(f"torch.compile failed, falling back to eager mode: {e}")
+        client.static_shapes = None
+
+
+def warm_up_model(client, batch_sizes: List[int], audio_seconds: float):
+    """
+    以假音訊對每個批次大小執行有/無 prompt 的推論各一次 (torch.compile 的 bucket 由 compile_static_shapes 編譯)。
+    """
+    rng = np.random.default_rng(0)
+    for batch_size in batch_sizes:
+        audio_list = [
+            {
+                "array": (rng.standard_normal(int(audio_seconds * TARGET_SAMPLING_RATE)) * 0.1).astype(np.float32),
+                "sampling_rate": TARGET_SAMPLING_RATE,
+            }
+            for _ in range(batch_size)
+        ]
+        started_at = time.time()
+        client.predict_batch(audio_list, None, return_pairs=False, audio_prepared=True)
+        client.predict_batch(audio_list, [WARMUP_PROMPT] * batch_size, return_pairs=False, audio_prepared=True)
+        # predict_batch 回傳 Python 串列，GPU 上的運算在此之前已經完成
+        print(f"Warm-up batch of {batch_size} finished in {time.time() - started_at:.2f}s.")
+
+
+def _replica_main(
+    conn, engine: str, num_threads: int, warmup_batch_sizes: List[int], warmup_audio_seconds: float,
+    client_options: dict,
+):
+    """
+    Replica process：載入模型並暖機後回報 ready，之後逐一處理 (audio_list, transcription_list)。
+    """
+    if engine == "torch":
+        import torch
+        torch.set_num_interop_threads(1)
+    try:
+        client = create_inference_client(engine, num_threads, client_options)
+        device = client.device
+        compile_static_shapes(client)
+        warmed = False
+        if warmup_batch_sizes:
+            try:
+                warm_up_model(client, warmup_batch_sizes, warmup_audio_seconds)
+                warmed = True
+            except Exception as e:
+                print(f"Replica warm-up failed: {e}")
+        conn.send(("ready", {
+            "model_fingerprint": client.model_fingerprint, "device": device, "warmed": warmed,
+            "bucket_stats": client.bucket_stats(),
+        }))
+    except Exception as e:
+        conn.send(("error", f"Failed to load model: {e}"))
+        return
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        audio_list, transcription_list = message
+        try:
+            results = client.predict_batch(audio_list, transcription_list, return_pairs=False, audio_prepared=True)
+            # 統計跟著結果回傳，主進程不必另外詢問 replica
+            conn.send(("ok", (results, client.bucket_stats())))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+class InferenceReplicaPool:
+    """
+    N 個推論 replica process 加上一個排程器。predict_batch 與 WhiStressInferenceClient 相同
+    (音訊需已前處理，回傳 (transcription, stresses) 格式)，可同時由多個執行緒呼叫。
+    結束的 replica 會自動重新啟動；無法重啟且沒有任何 replica 時，等待中與之後的批次都直接失敗，
+    並呼叫 on_unavailable。
+    """
+
+    def __init__(
+        self,
+        num_replicas: int,
+        threads_per_replica: int,
+        warmup_batch_sizes: List[int] = (),
+        warmup_audio_seconds: float = 1.0,
+        client_options: Optional[dict] = None,
+        engine: str = "torch",
+        on_unavailable: Optional[Callable[[], None]] = None,
+    ):
+        self._context = multiprocessing.get_context("spawn")
+        self._replica_args = (
+            engine, threads_per_replica, list(warmup_batch_sizes), warmup_audio_seconds, client_options or {},
+        )
+        self._on_unavailable = on_unavailable
+        self._tasks = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self.available = True
+        self._replicas = [self._spawn_replica(i) for i in range(num_replicas)]
+        self._alive_replicas = num_replicas
+
+        # 等待所有 replica 載入完成
+        statuses = []
+        for process, conn in self._replicas:
+            try:
+                statuses.append(self._wait_ready(process, conn))
+            except RuntimeError:
+                self.shutdown()
+                raise
+        self.model_fingerprint = statuses[0]["model_fingerprint"]
+        self.device = statuses[0]["device"]
+        self.warmed = all(status["warmed"] for status in statuses)
+        self._bucket_stats = [status["bucket_stats"] for status in statuses]
+        print(f"Started {num_replicas} inference replicas with {threads_per_replica} threads each.")
+
+        for index in range(num_replicas):
+            threading.Thread(
+                target=self._dispatch_loop, args=(index,), name=f"whistress-replica-{index}-dispatch", daemon=True
+            ).start()
+
+    def _spawn_replica(self, index: int):
+        parent_conn, child_conn = self._context.Pipe()
+        process = self._context.Process(
+            target=_replica_main,
+            args=(child_conn, *self._replica_args),
+            name=f"whistress-replica-{index}",
+            daemon=True,
+        )
+        process.start()
+        # 只留子程序那一端，子程序結束時 parent_conn 才會收到 EOF
+        child_conn.close()
+        return process, parent_conn
+
+    @staticmethod
+    def _wait_ready(process, conn) -> dict:
+        # 同時等待 ready 訊息與 process 結束 (例如載入模型時被 OOM killer 結束)，不會永久阻塞
+        multiprocessing.connection.wait([conn, process.sentinel])
+        try:
+            if not conn.poll():
+                raise EOFError
+            status, payload = conn.recv()
+        except (EOFError, OSError):
+            process.join(timeout=5)
+            raise RuntimeError(f"Inference replica {process.name} exited with code {process.exitcode} while starting.")
+        if status != "ready":
+            raise RuntimeError(f"Inference replica {process.name} failed to start: {payload}")
+        return payload
+
+    def _restart_replica(self, index: int) -> bool:
+        process, _ = self._replicas[index]
+        process.join(timeout=5)
+        print(f"Inference replica {process.name} exited with code {process.exitcode}; restarting it.")
+        process, conn = self._spawn_replica(index)
+        self._replicas[index] = (process, conn)
+        try:
+            self._bucket_stats[index] = self._wait_ready(process, conn)["bucket_stats"]
+        except RuntimeError as e:
+            print(e)
+            return False
+        print(f"Inference replica {process.name} restarted.")
+        return True
+
+    def _replica_lost(self):
+        # 沒有任何 replica 時，讓等待中的批次失敗，之後的 submit 也直接失敗
+        with self._lock:
+            self._alive_replicas -= 1
+            if self._alive_replicas > 0 or self._closed:
+                return
+            self.available = False
+            while True:
+                try:
+                    task = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None and task[0].set_running_or_notify_cancel():
+                    task[0].set_exception(RuntimeError("No inference replica is available."))
+        print("All inference replicas are gone.")
+        if self._on_unavailable is not None:
+            self._on_unavailable()
+
+    def _dispatch_loop(self, index: int):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            if not self._replicas[index][0].is_alive() and not self._closed:
+                # replica 在閒置時結束：先重新啟動，這個批次不受影響
+                if not self._restart_replica(index):
+                    self._tasks.put(task) # 交給其他 replica (沒有的話由 _replica_lost 標記失敗)
+                    self._replica_lost()
+                    break
+            future, audio_list, transcription_list = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            process, conn = self._replicas[index]
+            try:
+                conn.send((audio_list, transcription_list))
+                status, payload = conn.recv()
+            except (EOFError, OSError) as e:
+                # replica 在推論中結束 (例如被 OOM killer 結束)：這個批次失敗，重新啟動 replica
+                future.set_exception(RuntimeError(f"Inference replica {process.name} exited: {e}"))
+                if self._closed:
+                    break
+                if not self._restart_replica(index):
+                    self._replica_lost()
+                    break
+                continue
+            if status == "ok":
+                results, self._bucket_stats[index] = payload
+                future.set_result(results)
+            else:
+                future.set_exception(RuntimeError(payload))
+
+    def bucket_stats(self):
+        """
+        所有 replica 的 torch.compile bucket 統計加總 (未使用 torch.compile 時為 None)。
+        """
+        replica_stats = [stats for stats in self._bucket_stats if stats is not None]
+        if not replica_stats:
+            return None
+        combined = {}
+        for stats in replica_stats:
+            for name, counts in stats.items():
+                total = combined.setdefault(name, {"hits": 0, "misses": 0, "eager": 0, "buckets": set()})
+                for key in ("hits", "misses", "eager"):
+                    total[key] += counts[key]
+                total["buckets"].update(tuple(bucket) for bucket in counts["buckets"])
+        for total in combined.values():
+            total["buckets"] = sorted(total["buckets"])
+        return combined
+
+    def submit(self, audio_list: list, transcription_list: Optional[List[str]] = None) -> Future:
+        future = Future()
+        with self._lock:
+            if not self.available:
+                future.set_exception(RuntimeError("No inference replica is available."))
+                return future
+            self._tasks.put((future, audio_list, transcription_list))
+        return future
+
+    def predict_batch(self, audio_list, transcription_list=None, return_pairs=False, audio_prepared=True):
+        if return_pairs or not audio_prepared:
+            raise ValueError("Inference replicas only accept prepared audio and return formatted results.")
+        return self.submit(audio_list, transcription_list).result()
+
+    def shutdown(self):
+        self._closed = True
+        for _ in self._replicas:
+            self._tasks.put(None)
+        for process, conn in self._replicas:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for process, _ in self._replicas:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
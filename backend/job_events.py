@@ -0,0 +1,64 @@
+import asyncio
+import json
+import redis.asyncio as aioredis
+from job_queue import WHISTRESS_REDIS_URL, JOB_EVENTS_CHANNEL
+
+
+class JobEventListener:
+    """
+    API 行程內共用一條 Redis pub/sub 連線，依 job ID 把 Worker 發布的完成通知
+    分派給等待中的 SSE 連線 (而不是每個連線各自訂閱)。
+    """
+
+    def __init__(self, redis_url: str = WHISTRESS_REDIS_URL):
+        self.redis_url = redis_url
+        self._waiters = {}  # job_id -> set of asyncio.Future
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def register(self, job_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(job_id, set()).add(future)
+        return future
+
+    def unregister(self, job_id: str, future: asyncio.Future):
+        waiters = self._waiters.get(job_id)
+        if waiters is not None:
+            waiters.discard(future)
+            if not waiters:
+                del self._waiters[job_id]
+
+    async def _listen(self):
+        while True:
+            client = aioredis.from_url(self.redis_url)
+            pubsub = client.pubsub()
+            try:
+                await pubsub.subscribe(JOB_EVENTS_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    event = json.loads(message["data"])
+                    for future in self._waiters.pop(event["job_id"], ()):
+                        if not future.done():
+                            future.set_result(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 斷線期間的通知會遺失，SSE 端點會定期回頭檢查結果作為保底
+                print(f"Job event listener error: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+                await client.aclose()
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import redis # 需要安裝 pip install redis
+from typing import List, Optional, Tuple
+
+# --- Redis 批次佇列 ---
+# 音訊以原始 bytes 存在自己的 key (有 TTL)，佇列中只放精簡的參照紀錄，
+# 不再把 base64 字串塞進 JSON 再推進 Redis 列表。
+# 使用不同的 DB，以防與 Celery 的 broker/backend 衝突
+WHISTRESS_REDIS_URL = os.getenv("WHISTRESS_REDIS_URL", "redis://localhost:6379/1")
+redis_client = redis.StrictRedis.from_url(WHISTRESS_REDIS_URL)
+
+REDIS_BATCH_QUEUE_KEY = "whistress_inference_batch_queue"
+AUDIO_BLOB_KEY_PREFIX = "whistress:audio:"
+# 音訊在佇列中最多保留多久 (Worker 取走後立即刪除，TTL 只是保底)
+AUDIO_BLOB_TTL_SECONDS = int(os.getenv("WHISTRESS_AUDIO_BLOB_TTL_SECONDS", "3600"))
+
+
+def audio_blob_key(job_id: str) -> str:
+    return f"{AUDIO_BLOB_KEY_PREFIX}{job_id}"
+
+
+def enqueue_job(job_id: str, audio_bytes: bytes, prompt_text: Optional[str] = None) -> dict:
+    """
+    將音訊 bytes 存到 audio_blob_key(job_id)，並把參照紀錄推入批次佇列 (同一個 pipeline)。
+    """
+    return enqueue_jobs([(job_id, audio_bytes, prompt_text)])[0]
+
+
+def enqueue_jobs(jobs: List[Tuple[str, bytes, Optional[str]]]) -> List[dict]:
+    """
+    一次排入多個 (job_id, audio_bytes, prompt_text)：所有音訊與一個多值 LPUSH 在同一個 pipeline 寫入。
+    """
+    if not jobs:
+        return []
+    enqueued_at = time.time() # 用於批次的最長等待時間
+    records = [
+        {"original_task_id": job_id, "prompt_text": prompt_text, "enqueued_at": enqueued_at}
+        for job_id, _, prompt_text in jobs
+    ]
+    pipe = redis_client.pipeline()
+    for job_id, audio_bytes, _ in jobs:
+        pipe.set(audio_blob_key(job_id), audio_bytes, ex=AUDIO_BLOB_TTL_SECONDS)
+    # 將任務紀錄推送到 Redis 列表的左側 (作為 FIFO 佇列，Worker 從右側取出)
+    pipe.lpush(REDIS_BATCH_QUEUE_KEY, *[json.dumps(record) for record in records])
+    pipe.execute()
+    return records
+
+
+def fetch_audio_blobs(job_ids: List[str]) -> List[Optional[bytes]]:
+    """
+    以一次 MGET 取回多個任務的音訊 bytes 並刪除 (過期或不存在的項目為 None)。
+    """
+    if not job_ids:
+        return []
+    keys = [audio_blob_key(job_id) for job_id in job_ids]
+    pipe = redis_client.pipeline()
+    pipe.mget(keys)
+    pipe.unlink(*keys)
+    blobs, _ = pipe.execute()
+    return blobs
+
+
+# --- 任務完成通知 (Redis pub/sub) ---
+# Worker 寫入結果後發布到同一個頻道，API 的 SSE 端點據此推送結果，前端不必輪詢
+JOB_EVENTS_CHANNEL = "whistress:job_events"
+
+
+def publish_job_event(job_id: str, event: dict):
+    """
+    發布任務狀態，event 與 /tasks/{task_id} 的回應格式相同 (例如 {"status": "COMPLETED", "result": {...}})。
+    """
+    redis_client.publish(JOB_EVENTS_CHANNEL, json.dumps({"job_id": job_id, **event}))
+
+
+# --- Worker 心跳 ---
+# 每個 Worker 行程定期寫入自己的狀態 (有 TTL)，API 的 /ready 端點依此回報 Worker 數量與模型狀態
+WORKER_HEARTBEAT_KEY_PREFIX = "whistress:worker:"
+WORKER_HEARTBEAT_INTERVAL_SECONDS = float(os.getenv("WHISTRESS_WORKER_HEARTBEAT_INTERVAL_SECONDS", "10"))
+# 超過這個時間沒有更新就視為 Worker 已離線
+WORKER_HEARTBEAT_TTL_SECONDS = int(WORKER_HEARTBEAT_INTERVAL_SECONDS * 3)
+
+
+def publish_worker_heartbeat(worker_id: str, status: dict):
+    redis_client.set(
+        WORKER_HEARTBEAT_KEY_PREFIX + worker_id,
+        json.dumps({**status, "updated_at": time.time()}),
+        ex=WORKER_HEARTBEAT_TTL_SECONDS,
+    )
+
+
+def clear_worker_heartbeat(worker_id: str):
+    redis_client.delete(WORKER_HEARTBEAT_KEY_PREFIX + worker_id)
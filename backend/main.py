@@ -1,12 +1,21 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
-from celery.result import AsyncResult # 用於查詢 Celery 任務狀態
-from tasks import analyze_stress_task, celery_app, test_fastapi_backend_read  # 從 tasks.py 導入 Celery 應用和任務
+from fastapi.responses import JSONResponse, StreamingResponse
+from celery_app import celery_app, CELERY_BROKER_URL, CELERY_RESULT_BACKEND  # 只匯入 Celery 設定，不載入模型 (見 celery_app.py)
+from job_queue import ( # 直接把任務寫入批次佇列
+    enqueue_jobs, WHISTRESS_REDIS_URL, REDIS_BATCH_QUEUE_KEY, WORKER_HEARTBEAT_KEY_PREFIX,
+)
+from result_cache import get_cached_results_for_raw_audio # 相同錄音與 prompt 的推論結果快取
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel
+from typing import List
 import json
 from fastapi.middleware.cors import CORSMiddleware
 import traceback
-import time
-import redis
+import redis.asyncio as aioredis
+import uuid
+import os
+import asyncio
+from job_events import JobEventListener # Worker 完成通知 (Redis pub/sub)
 # --- FastAPI 應用初始化 ---
 app = FastAPI(
     title="WhiStress POC Backend",
@@ -21,36 +30,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# SSE 連線在等待期間送出 keep-alive 的間隔 (同時回頭檢查結果，避免錯過通知)
+SSE_KEEPALIVE_SECONDS = float(os.getenv("WHISTRESS_SSE_KEEPALIVE_SECONDS", "15"))
+job_event_listener = JobEventListener()
+
 @app.on_event("startup")
-async def startup_event():
-    print("FastAPI 應用程式啟動中...")
-    try:
-        # 現在呼叫的是 tasks.py 中定義的測試任務
-        test_task = test_fastapi_backend_read.delay("hello_celery") 
-        print(f"DEBUG: 發送測試任務: {test_task.id}")
-        
-        # 給 Worker 一點時間處理
-        time.sleep(2) 
-        
-        test_result = AsyncResult(test_task.id, app=celery_app)
-        print(f"DEBUG: 測試任務狀態: {test_result.state}")
-        print(f"DEBUG: 測試任務結果: {test_result.result}")
-        print(f"DEBUG: 測試任務結果類型: {type(test_result.result)}")
-
-        if test_result.successful() and test_result.result == "Test value received: hello_celery":
-            print("DEBUG: Celery 後端連接與讀取測試成功！")
-        else:
-            print("DEBUG: Celery 後端連接或讀取測試失敗！請檢查 Redis 連線和 Celery 配置。")
-            print(f"DEBUG: 預期結果: 'Test value received: hello_celery', 實際結果: {test_result.result}")
-    except Exception as e:
-        print(f"DEBUG: 啟動時執行 Celery 測試任務時發生錯誤: {e}")
+async def start_job_event_listener():
+    job_event_listener.start()
+
+@app.on_event("shutdown")
+async def stop_job_event_listener():
+    await job_event_listener.stop()
 
 # --- 1. 定義非同步 API 接口 ---
 @app.post("/analyze_stress_async")
 async def analyze_stress_async(audio_file: UploadFile = File(...), prompt_text: str = Form(None)):
     """
-    接收音頻檔案和引導文本，將重音模式分析任務發送到 Celery 佇列。
-    立即返回任務 ID。
+    接收音頻檔案和引導文本，將重音模式分析任務直接寫入批次佇列。
+    立即返回任務 ID (結果會以同一個 ID 寫入 Celery backend)。
     """
     print(f"INFO: Received request for analyze_stress_async with prompt: {prompt_text}")
     print(f"INFO: Audio file name: {audio_file.filename}, content type: {audio_file.content_type}")
@@ -63,16 +60,24 @@ async def analyze_stress_async(audio_file: UploadFile = File(...), prompt_text:
     try:
         print("INFO: Attempting to read audio file bytes...")
         audio_bytes = await audio_file.read()
-        # 將任務發送到 Celery 佇列
-        # audio_bytes 直接作為參數傳遞
-        print("INFO: Attempting to submit task to Celery...")
-        task = analyze_stress_task.delay(audio_bytes, prompt_text)
-        print(f"INFO: Task submitted to Celery. Task ID: {task.id}")
+        # 查快取與寫入佇列都是同步的 Redis 呼叫，與批次提交共用 submit_uploads，在 threadpool 中執行
+        submitted = await run_in_threadpool(submit_uploads, [(audio_bytes, prompt_text)])
+        task_id = submitted["task_ids"][0]
+        # 相同的錄音與 prompt 已經分析過，直接回傳結果，不必排入佇列
+        if task_id in submitted["results"]:
+            print(f"INFO: Served from result cache. Task ID: {task_id}")
+            return JSONResponse(content={
+                "success": True,
+                "message": "Analysis result served from cache.",
+                "task_id": task_id,
+                "result": submitted["results"][task_id]
+            })
+        print(f"INFO: Task submitted to batch queue. Task ID: {task_id}")
         # 立即返回任務 ID
         return JSONResponse(content={
             "success": True,
             "message": "Analysis task submitted successfully.",
-            "task_id": task.id
+            "task_id": task_id
         })
 
     except Exception as e:
@@ -80,86 +85,264 @@ async def analyze_stress_async(audio_file: UploadFile = File(...), prompt_text:
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-# --- 2. 定義查詢任務狀態和結果的 API 接口 ---
-@app.get("/tasks/{task_id}")
-async def get_task_status(task_id: str):
+# --- 1b. 批次提交：一次請求上傳多個音檔 ---
+# 一次最多接受的音檔數
+BULK_MAX_FILES = int(os.getenv("WHISTRESS_BULK_MAX_FILES", "200"))
+
+def submit_uploads(uploads: list) -> dict:
     """
-    根據任務 ID 查詢 Celery 任務的狀態和結果。
+    同步執行 (在 threadpool 中)：批次查結果快取，未命中的以一個 pipeline 全部排入佇列。
     """
-    task_result = celery_app.backend.get_task_meta(task_id)
+    task_ids = [str(uuid.uuid4()) for _ in uploads]
+    cached_results = get_cached_results_for_raw_audio(uploads)
+    results = {}
+    jobs = []
+    for task_id, (audio_bytes, prompt_text), cached_result in zip(task_ids, uploads, cached_results):
+        if cached_result is not None:
+            celery_app.backend.store_result(task_id, cached_result, state='SUCCESS')
+            results[task_id] = json.loads(cached_result)
+        else:
+            jobs.append((task_id, audio_bytes, prompt_text))
+    enqueue_jobs(jobs)
+    return {"task_ids": task_ids, "results": results}
 
-    current_redis_backend_conn = redis.StrictRedis(host='localhost', port=6379, db=1)
-    # get_task_meta 返回的是一個字典，其中包含 'status' 和 'result'
-    current_status = task_result.get('status', 'PENDING')
-    current_result = task_result.get('result')
+@app.post("/analyze_stress_batch")
+async def analyze_stress_batch(audio_files: List[UploadFile] = File(...), prompt_texts: List[str] = Form(None)):
+    """
+    一次接收多個音頻檔案 (與對應的 prompt_texts，依序對應；空字串表示無 prompt)，
+    以一次 pipeline 寫入批次佇列。task_ids 的順序與上傳的檔案相同，
+    已在快取中的結果直接放在 results 中。
+    """
+    if len(audio_files) > BULK_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many files. At most {BULK_MAX_FILES} per request.")
+    if prompt_texts and len(prompt_texts) != len(audio_files):
+        raise HTTPException(status_code=400, detail="prompt_texts must have one entry per audio file.")
+    for audio_file in audio_files:
+        if not (audio_file.content_type or "").startswith("audio/"):
+            raise HTTPException(status_code=400, detail=f"Invalid file type for {audio_file.filename}. Please upload audio files.")
+
+    try:
+        prompts = prompt_texts or [None] * len(audio_files)
+        uploads = [
+            (await audio_file.read(), prompt_text or None)
+            for audio_file, prompt_text in zip(audio_files, prompts)
+        ]
+        submitted = await run_in_threadpool(submit_uploads, uploads)
+        print(f"INFO: Bulk submitted {len(uploads)} tasks ({len(submitted['results'])} served from cache).")
+        return JSONResponse(content={
+            "success": True,
+            "message": "Analysis tasks submitted successfully.",
+            **submitted
+        })
+    except Exception as e:
+        print(f"Error submitting bulk analysis tasks: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+# --- 2. 讀取任務結果 ---
+# 共用的 async 連線池 (Celery result backend 所在的 Redis)，每次查詢只做一次 GET，不阻塞事件迴圈
+result_backend_redis = aioredis.from_url(CELERY_RESULT_BACKEND)
+
+@app.on_event("shutdown")
+async def close_result_backend_redis():
+    await result_backend_redis.aclose()
+
+async def read_task_meta(task_id: str) -> dict:
+    """
+    以一次 GET 讀取任務的 Celery 結果，解碼方式與 celery_app.backend.get_task_meta 相同。
+    """
+    raw_meta = await result_backend_redis.get(celery_app.backend.get_key_for_task(task_id))
+    if not raw_meta:
+        return {"status": "PENDING", "result": None}
+    return celery_app.backend.decode_result(raw_meta)
 
-    redis_key_main_task = f"celery-task-meta-{task_id}"
-    raw_redis_data_main_task = current_redis_backend_conn.get(redis_key_main_task)
-    print(f"DEBUG: Redis Key (主任務): {redis_key_main_task}")
-    print(f"DEBUG: 原始 Redis 數據 (主任務): {raw_redis_data_main_task}")
-    if raw_redis_data_main_task:
+async def read_task_metas(task_ids: List[str]) -> List[dict]:
+    """
+    read_task_meta 的批次版本：以一次 MGET 讀取多個任務的結果。
+    """
+    raw_metas = await result_backend_redis.mget([celery_app.backend.get_key_for_task(task_id) for task_id in task_ids])
+    return [
+        celery_app.backend.decode_result(raw_meta) if raw_meta else {"status": "PENDING", "result": None}
+        for raw_meta in raw_metas
+    ]
+
+def parse_task_result(current_result):
+    # Worker 以 JSON 字串儲存結果
+    if isinstance(current_result, str):
         try:
-            parsed_redis_data_main = json.loads(raw_redis_data_main_task)
-            print(f"DEBUG: 解析後的 Redis 數據 (主任務): {parsed_redis_data_main}")
+            return json.loads(current_result)
         except json.JSONDecodeError:
-            print(f"DEBUG: 無法解析 Redis 數據 (主任務): {raw_redis_data_main_task}")
-
-    print(f"\n--- 查詢任務 {task_id} ---")
-    print(f"DEBUG: 原始狀態: {current_status}") # 使用從 get_task_meta 獲取到的狀態
-    print(f"DEBUG: 原始結果: {current_result}") # 使用從 get_task_meta 獲取到的結果
-    print(f"DEBUG: 原始結果類型: {type(current_result)}")
-    # 以下邏輯保持不變，但現在使用 current_status 和 current_result
-    if current_status in ["SUCCESS", "FAILURE"]: # 任務已完成或失敗
-        if current_status == "SUCCESS":
-            result_data = None
-            if isinstance(current_result, str):
+            return current_result
+    return current_result
+
+async def finished_task_event(task_id: str):
+    """
+    任務已完成時回傳與 /tasks/{task_id} 相同格式的事件，否則回傳 None。
+    """
+    task_result = await read_task_meta(task_id)
+    current_status = task_result.get('status', 'PENDING')
+    if current_status == "SUCCESS":
+        return {"status": "COMPLETED", "result": parse_task_result(task_result.get('result'))}
+    if current_status == "FAILURE":
+        return {"status": "FAILED", "error": str(task_result.get('result'))}
+    return None
+
+# --- 3. 以 Server-Sent Events 推送任務結果 ---
+@app.get("/tasks/{task_id}/events")
+async def stream_task_result(task_id: str):
+    """
+    保持連線，Worker 發布完成通知後立即推送結果 (取代每秒輪詢 /tasks/{task_id})。
+    """
+    # 先註冊再檢查目前狀態，避免結果剛好在兩者之間寫入而錯過通知
+    future = job_event_listener.register(task_id)
+
+    async def event_stream():
+        try:
+            event = await finished_task_event(task_id)
+            while event is None:
                 try:
-                    result_data = json.loads(current_result)
-                    print(f"DEBUG: 解析字串結果為字典: {result_data}")
-                except json.JSONDecodeError:
-                    result_data = current_result
-                    print(f"DEBUG: 結果是無法解析的字串: {result_data}")
-            elif isinstance(current_result, dict):
-                result_data = current_result
-                print(f"DEBUG: 結果直接是字典: {result_data}")
-            else:
-                result_data = str(current_result)
-                print(f"DEBUG: 結果是其他類型 (轉字串): {result_data}")
-
-            if isinstance(result_data, dict):
-                print(f"DEBUG: 判斷 result_data['status']: {result_data.get('status')}")
-            else:
-                print(f"DEBUG: result_data 不是字典，無法檢查 'status' 鍵。")
-
-            if isinstance(result_data, dict) and (result_data.get("status") == "SUBMITTED_TO_BATCH" or result_data.get("status") == "PREDICTED"):
-                print(f"DEBUG: 返回 COMPLETED")
-                return JSONResponse(content={
-                    "status": "COMPLETED",
-                    "result": result_data
-                })
-                '''
-                return JSONResponse(content={
-                    "status": "PENDING_BATCH_PROCESSING",
-                    "message": result_data.get("message", "Task is waiting in batch queue."),
-                    "task_id": task_id
-                })
-                '''
-            else:
-                return JSONResponse(content={
-                    "status": "PENDING_BATCH_PROCESSING",
-                    "message": result_data.get("message", "Task is waiting in batch queue."),
-                    "task_id": task_id
-                })
-        else: # current_status == "FAILURE"
-            print(f"DEBUG: 任務 {task_id} 失敗: {current_result}")
-            return JSONResponse(content={
-                "status": "FAILED",
-                "error": str(current_result)
-            }, status_code=500)
-    else: # 任務仍在進行中
-        print(f"DEBUG: 任務 {task_id} 仍在進行中 (狀態: {current_status})")
-        return JSONResponse(content={
-            "status": current_status,
+                    event = await asyncio.wait_for(asyncio.shield(future), timeout=SSE_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    event = await finished_task_event(task_id)
+            event.pop("job_id", None)
+            yield f"data: {json.dumps(event)}\n\n"
+        finally:
+            job_event_listener.unregister(task_id, future)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- 4. 定義查詢任務狀態和結果的 API 接口 ---
+def task_status_content(task_id: str, task_result: dict):
+    """
+    將任務的 Celery 結果轉換為 /tasks/{task_id} 的回應內容，回傳 (content, status_code)。
+    """
+    current_status = task_result.get('status', 'PENDING')
+    current_result = task_result.get('result')
+
+    if current_status == "SUCCESS":
+        result_data = parse_task_result(current_result)
+        if isinstance(result_data, dict) and result_data.get("status") == "PREDICTED":
+            return {
+                "status": "COMPLETED",
+                "result": result_data
+            }, 200
+        return {
+            "status": "PENDING_BATCH_PROCESSING",
+            "message": "Task is waiting in batch queue.",
             "task_id": task_id
-        })
-    
\ No newline at end of file
+        }, 200
+    if current_status == "FAILURE":
+        return {
+            "status": "FAILED",
+            "error": str(current_result)
+        }, 500
+    # 任務仍在進行中
+    return {
+        "status": current_status,
+        "task_id": task_id
+    }, 200
+
+@app.get("/tasks/{task_id}")
+async def get_task_status(task_id: str):
+    """
+    根據任務 ID 查詢任務的狀態和結果 (共用 async 連線池，一次 GET)。
+    """
+    content, status_code = task_status_content(task_id, await read_task_meta(task_id))
+    return JSONResponse(content=content, status_code=status_code)
+
+class TaskIdsRequest(BaseModel):
+    task_ids: List[str]
+
+@app.post("/tasks/status")
+async def get_tasks_status(request: TaskIdsRequest):
+    """
+    一次查詢多個任務 (一次 MGET)，回傳 {task_id: 與 /tasks/{task_id} 相同的內容}。
+    """
+    if len(request.task_ids) > BULK_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many task IDs. At most {BULK_MAX_FILES} per request.")
+    if not request.task_ids:
+        return JSONResponse(content={"tasks": {}})
+    task_results = await read_task_metas(request.task_ids)
+    return JSONResponse(content={"tasks": {
+        task_id: task_status_content(task_id, task_result)[0]
+        for task_id, task_result in zip(request.task_ids, task_results)
+    }})
+
+
+# --- 5. 存活與就緒檢查 ---
+# 啟動時不再送測試任務並 sleep；部署與自動擴展改用這兩個端點判斷狀態
+READINESS_CHECK_TIMEOUT_SECONDS = float(os.getenv("WHISTRESS_READINESS_CHECK_TIMEOUT_SECONDS", "1"))
+broker_redis = aioredis.from_url(CELERY_BROKER_URL)
+queue_redis = aioredis.from_url(WHISTRESS_REDIS_URL)
+
+@app.on_event("shutdown")
+async def close_readiness_redis():
+    await broker_redis.aclose()
+    await queue_redis.aclose()
+
+@app.get("/health")
+async def health():
+    """
+    存活檢查：API 行程可以回應即可。
+    """
+    return {"status": "ok"}
+
+async def ping(client) -> bool:
+    try:
+        return await asyncio.wait_for(client.ping(), timeout=READINESS_CHECK_TIMEOUT_SECONDS)
+    except Exception:
+        return False
+
+async def read_workers() -> dict:
+    """
+    讀取所有仍在心跳的 Worker 狀態 (見 tasks.worker_heartbeat_loop)。
+    """
+    keys = [key async for key in queue_redis.scan_iter(match=WORKER_HEARTBEAT_KEY_PREFIX + "*")]
+    if not keys:
+        return {}
+    workers = {}
+    for key, raw_status in zip(keys, await queue_redis.mget(keys)):
+        if raw_status:
+            workers[key.decode("utf-8")[len(WORKER_HEARTBEAT_KEY_PREFIX):]] = json.loads(raw_status)
+    return workers
+
+@app.get("/ready")
+async def ready():
+    """
+    就緒檢查：broker / result backend / 批次佇列的 Redis 是否可連線、Worker 數量與模型狀態、佇列深度。
+    至少一個 Worker 已載入模型並完成暖機 (ready) 時才回傳 200，否則 503。
+    """
+    broker_ok, backend_ok, queue_ok = await asyncio.gather(
+        ping(broker_redis), ping(result_backend_redis), ping(queue_redis)
+    )
+    workers = {}
+    queue_depth = None
+    if queue_ok:
+        try:
+            workers, queue_depth = await asyncio.wait_for(
+                asyncio.gather(read_workers(), queue_redis.llen(REDIS_BATCH_QUEUE_KEY)),
+                timeout=READINESS_CHECK_TIMEOUT_SECONDS,
+            )
+        except Exception as e:
+            print(f"Readiness check failed to read workers: {e}")
+            queue_ok = False
+    models_loaded = sum(1 for status in workers.values() if status.get("model_loaded"))
+    workers_ready = sum(1 for status in workers.values() if status.get("ready"))
+    is_ready = broker_ok and backend_ok and queue_ok and workers_ready > 0
+    return JSONResponse(content={
+        "ready": is_ready,
+        "broker": broker_ok,
+        "result_backend": backend_ok,
+        "queue": queue_ok,
+        "queue_depth": queue_depth,
+        "workers": len(workers),
+        "workers_with_model_loaded": models_loaded,
+        "workers_warmed": sum(1 for status in workers.values() if status.get("warmed")),
+        "workers_ready": workers_ready,
+        "worker_status": workers,
+    }, status_code=200 if is_ready else 503)
@@ -0,0 +1,26 @@
+from pathlib import Path
+from whistress.inference_client.utils import PATH_TO_WEIGHTS, load_unpacked_model, get_model_fingerprint
+from whistress.model.model import PACKED_WEIGHTS_FILENAME
+
+# 將 download_weights.py 下載的檔案 (classifier.pt / additional_decoder_block.pt / metadata.json)
+# 與 Hugging Face 上的 Whisper backbone 打包成單一個 safetensors 檔案。
+# Worker 之後會以 memory map 載入 (不再呼叫 from_pretrained)，同一台機器上的多個 Worker 共用實體記憶體。
+#
+# 用法: python backend/pack_weights.py
+# Expected dir structure:
+# ```
+# whistress/
+# ├── weights/
+# │   └── additional_decoder_block.pt
+# │   └── classifier.pt
+# │   └── metadata.json
+# │   └── whistress.safetensors   <- 產生的檔案
+# ```
+
+packed_path = Path(PATH_TO_WEIGHTS) / PACKED_WEIGHTS_FILENAME
+
+model = load_unpacked_model("cpu")
+# 沿用原始檔案的指紋，打包前後的結果快取仍然有效
+model_fingerprint = get_model_fingerprint(model)
+model.save_packed(packed_path, model_fingerprint=model_fingerprint)
+print(f"✅ Packed weights written to {packed_path} ({packed_path.stat().st_size / 1e6:.0f} MB)")
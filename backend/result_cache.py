@@ -0,0 +1,273 @@
+import os
+import json
+import time
+import hashlib
+from typing import List, Optional, Tuple
+from job_queue import redis_client, WORKER_HEARTBEAT_KEY_PREFIX, WORKER_HEARTBEAT_TTL_SECONDS
+
+# --- 推論結果快取 (存在 Redis) ---
+# 快取 key 由「正規化後 16kHz 音訊的雜湊 + prompt + 模型指紋 (含 layer_for_head)」組成，
+# 同一段錄音重複送出時不必再解碼與推論。
+# API 收到的是原始上傳 bytes，所以另外記一個「原始 bytes 雜湊 -> 快取 key」的別名，
+# 讓 /analyze_stress_async 在排入佇列前就能命中快取。
+RESULT_CACHE_KEY_PREFIX = "whistress:result:"
+RAW_AUDIO_ALIAS_PREFIX = "whistress:raw_audio:"
+INFLIGHT_KEY_PREFIX = "whistress:inflight:"
+FOLLOWERS_KEY_PREFIX = "whistress:followers:"
+# 依最後存取時間排序的索引，用於數量上限的 LRU 淘汰
+RESULT_CACHE_INDEX_KEY = "whistress:result_cache:index"
+# 每個 Worker 隨心跳把自己的模型指紋寫入這個 sorted set (分數為最後回報時間)，API 對每個仍在回報的指紋
+# 計算別名 key。不同 Worker 可能執行不同的變體 (int8、bf16、onnx 各有自己的指紋)，不能只記一個。
+MODEL_FINGERPRINTS_KEY = "whistress:model_fingerprints"
+
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("WHISTRESS_RESULT_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+# 最多保留幾筆結果，0 表示停用快取
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("WHISTRESS_RESULT_CACHE_MAX_ENTRIES", "10000"))
+# 相同內容的請求正在推論時，後到的請求等待前一個結果的最長時間
+INFLIGHT_TTL_SECONDS = int(os.getenv("WHISTRESS_INFLIGHT_TTL_SECONDS", "600"))
+# 等待者列表比 claim 多留一段時間，claim 逾時後 reap_orphaned_followers 仍找得到它們
+FOLLOWERS_TTL_SECONDS = INFLIGHT_TTL_SECONDS * 2
+
+# claim_or_follow 的結果
+CACHED = "cached"
+OWNER = "owner"
+FOLLOWER = "follower"
+
+
+def result_cache_enabled() -> bool:
+    return RESULT_CACHE_MAX_ENTRIES > 0
+
+
+def _hash_parts(*parts) -> str:
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def cache_key_for_audio(audio_array, prompt_text: Optional[str], model_fingerprint: str) -> str:
+    """
+    以正規化後的 16kHz float32 音訊、prompt 與模型指紋計算快取 key。
+    """
+    # 這個模組也會被 API 匯入，所以不匯入 numpy；audio_array 為 numpy 陣列
+    audio_hash = hashlib.sha256(audio_array.astype("float32", copy=False).tobytes()).hexdigest()
+    return _hash_parts(audio_hash, prompt_text or "", model_fingerprint)
+
+
+def raw_audio_alias_key(audio_bytes: bytes, prompt_text: Optional[str], model_fingerprint: str) -> str:
+    return RAW_AUDIO_ALIAS_PREFIX + _hash_parts(hashlib.sha256(audio_bytes).hexdigest(), prompt_text or "", model_fingerprint)
+
+
+def publish_model_fingerprint(model_fingerprint: str):
+    """
+    Worker 端：載入模型後與每次心跳時呼叫，超過心跳 TTL 沒有回報的指紋視為已沒有 Worker 使用。
+    """
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.zadd(MODEL_FINGERPRINTS_KEY, {model_fingerprint: now})
+    pipe.zremrangebyscore(MODEL_FINGERPRINTS_KEY, "-inf", now - WORKER_HEARTBEAT_TTL_SECONDS)
+    pipe.execute()
+
+
+def live_model_fingerprints() -> List[str]:
+    return [
+        fingerprint.decode("utf-8")
+        for fingerprint in redis_client.zrangebyscore(
+            MODEL_FINGERPRINTS_KEY, time.time() - WORKER_HEARTBEAT_TTL_SECONDS, "+inf"
+        )
+    ]
+
+
+def get_cached_result(key: str) -> Optional[str]:
+    """
+    取回快取的結果 (JSON 字串)，命中時更新最後存取時間與 TTL。
+    """
+    result = redis_client.get(RESULT_CACHE_KEY_PREFIX + key)
+    if result is None:
+        return None
+    pipe = redis_client.pipeline()
+    pipe.expire(RESULT_CACHE_KEY_PREFIX + key, RESULT_CACHE_TTL_SECONDS)
+    pipe.zadd(RESULT_CACHE_INDEX_KEY, {key: time.time()})
+    pipe.execute()
+    return result.decode("utf-8")
+
+
+def get_cached_result_for_raw_audio(audio_bytes: bytes, prompt_text: Optional[str]) -> Optional[str]:
+    """
+    API 端：以原始上傳 bytes 查快取 (還沒有 Worker 發布模型指紋時一律視為未命中)。
+    """
+    return get_cached_results_for_raw_audio([(audio_bytes, prompt_text)])[0]
+
+
+def get_cached_results_for_raw_audio(uploads: List[Tuple[bytes, Optional[str]]]) -> List[Optional[str]]:
+    """
+    get_cached_result_for_raw_audio 的批次版本：每個上傳對所有仍在使用的模型指紋查別名，
+    別名與結果各以一次 MGET 讀取，任一指紋命中即可。
+    """
+    if not result_cache_enabled() or not uploads:
+        return [None] * len(uploads)
+    model_fingerprints = live_model_fingerprints()
+    if not model_fingerprints:
+        return [None] * len(uploads)
+    alias_keys = redis_client.mget([
+        raw_audio_alias_key(audio_bytes, prompt_text, model_fingerprint)
+        for audio_bytes, prompt_text in uploads
+        for model_fingerprint in model_fingerprints
+    ])
+    # 每個上傳取第一個命中的別名
+    keys = [
+        next((key for key in alias_keys[i:i + len(model_fingerprints)] if key is not None), None)
+        for i in range(0, len(alias_keys), len(model_fingerprints))
+    ]
+    hit_keys = [key.decode("utf-8") for key in keys if key is not None]
+    if not hit_keys:
+        return [None] * len(uploads)
+    results = dict(zip(hit_keys, redis_client.mget([RESULT_CACHE_KEY_PREFIX + key for key in hit_keys])))
+    now = time.time()
+    pipe = redis_client.pipeline()
+    for key, result in results.items():
+        if result is not None:
+            pipe.expire(RESULT_CACHE_KEY_PREFIX + key, RESULT_CACHE_TTL_SECONDS)
+            pipe.zadd(RESULT_CACHE_INDEX_KEY, {key: now})
+    pipe.execute()
+    return [
+        results[key.decode("utf-8")].decode("utf-8")
+        if key is not None and results[key.decode("utf-8")] is not None else None
+        for key in keys
+    ]
+
+
+def store_cached_result(key: str, result_json: str, raw_alias_keys: List[str] = ()):
+    """
+    寫入結果與原始 bytes 別名，超過 RESULT_CACHE_MAX_ENTRIES 時淘汰最久未使用的結果。
+    """
+    now = time.time()
+    pipe = redis_client.pipeline()
+    pipe.set(RESULT_CACHE_KEY_PREFIX + key, result_json, ex=RESULT_CACHE_TTL_SECONDS)
+    pipe.zadd(RESULT_CACHE_INDEX_KEY, {key: now})
+    # 索引的分數就是最後存取時間，早於 TTL 的項目已經過期
+    pipe.zremrangebyscore(RESULT_CACHE_INDEX_KEY, "-inf", now - RESULT_CACHE_TTL_SECONDS)
+    pipe.zcard(RESULT_CACHE_INDEX_KEY)
+    size = pipe.execute()[-1]
+    set_raw_aliases(key, raw_alias_keys)
+
+    excess = size - RESULT_CACHE_MAX_ENTRIES
+    if excess > 0:
+        evicted = [member.decode("utf-8") for member, _ in redis_client.zpopmin(RESULT_CACHE_INDEX_KEY, excess)]
+        if evicted:
+            redis_client.unlink(*[RESULT_CACHE_KEY_PREFIX + k for k in evicted])
+
+
+def set_raw_aliases(key: str, raw_alias_keys: List[str]):
+    """
+    記錄「原始 bytes 雜湊 -> 快取 key」，之後相同的上傳在 API 端就能命中。
+    """
+    raw_alias_keys = [k for k in raw_alias_keys if k]
+    if not raw_alias_keys:
+        return
+    pipe = redis_client.pipeline()
+    for raw_alias_key in raw_alias_keys:
+        pipe.set(raw_alias_key, key, ex=RESULT_CACHE_TTL_SECONDS)
+    pipe.execute()
+
+
+# --- 推論中的 claim ---
+# claim 記錄負責推論的任務與 Worker (JSON)。該 Worker 的心跳 key 消失 (見 job_queue.py) 就視為失效：
+# 後到的相同請求直接接手推論，等待者由 reap_orphaned_followers 標記為失敗。
+# 以下 Lua 腳本讓「檢查 claim 再修改」在 Redis 中一次完成。
+
+# 只有 claim 還在時才加入等待者，避免加入一個已經結束 (不會再有人寫回) 的推論
+_FOLLOW_SCRIPT = redis_client.register_script("""
+if redis.call("exists", KEYS[1]) == 0 then
+    return 0
+end
+redis.call("rpush", KEYS[2], ARGV[1])
+redis.call("expire", KEYS[2], ARGV[2])
+return 1
+""")
+# claim 仍是已離線的 Worker 持有時改由這個任務持有，等待者保留給新的負責者
+_TAKE_OVER_SCRIPT = redis_client.register_script("""
+if redis.call("get", KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call("set", KEYS[1], ARGV[2], "EX", ARGV[3])
+return 1
+""")
+# claim 屬於 ARGV[1] 這個任務 (或已逾時) 時刪除 claim 並取出所有等待者；claim 已被其他任務接手時不動
+_RELEASE_SCRIPT = redis_client.register_script("""
+local claim = redis.call("get", KEYS[1])
+if claim and cjson.decode(claim)["job_id"] ~= ARGV[1] then
+    return {}
+end
+local followers = redis.call("lrange", KEYS[2], 0, -1)
+redis.call("del", KEYS[1], KEYS[2])
+return followers
+""")
+
+
+def _owner_alive(claim: dict) -> bool:
+    return bool(redis_client.exists(WORKER_HEARTBEAT_KEY_PREFIX + claim["worker_id"]))
+
+
+def _release_claim(key: str, job_id: str) -> List[dict]:
+    raw_followers = _RELEASE_SCRIPT(keys=[INFLIGHT_KEY_PREFIX + key, FOLLOWERS_KEY_PREFIX + key], args=[job_id])
+    return [json.loads(raw_follower) for raw_follower in raw_followers]
+
+
+def claim_or_follow(key: str, job_id: str, worker_id: str, raw_alias_key: Optional[str] = None) -> Tuple[str, Optional[str]]:
+    """
+    合併相同內容的請求：
+      (CACHED, result)  已有快取結果
+      (OWNER, None)     由這個任務 (在 worker_id 上) 推論，完成後呼叫 finish_inflight
+      (FOLLOWER, None)  已有相同內容正在推論，結果會由 finish_inflight 一併寫回
+    """
+    claim = json.dumps({"job_id": job_id, "worker_id": worker_id})
+    follower = json.dumps({"job_id": job_id, "raw_alias_key": raw_alias_key})
+    for _ in range(3):
+        result = get_cached_result(key)
+        if result is not None:
+            return CACHED, result
+        if redis_client.set(INFLIGHT_KEY_PREFIX + key, claim, nx=True, ex=INFLIGHT_TTL_SECONDS):
+            return OWNER, None
+
+        current_claim = redis_client.get(INFLIGHT_KEY_PREFIX + key)
+        if current_claim is not None and not _owner_alive(json.loads(current_claim)):
+            # 負責的 Worker 已離線，由這個任務重新推論 (也會寫回給原本的等待者)
+            if _TAKE_OVER_SCRIPT(keys=[INFLIGHT_KEY_PREFIX + key], args=[current_claim, claim, INFLIGHT_TTL_SECONDS]):
+                return OWNER, None
+            continue
+        if _FOLLOW_SCRIPT(keys=[INFLIGHT_KEY_PREFIX + key, FOLLOWERS_KEY_PREFIX + key], args=[follower, FOLLOWERS_TTL_SECONDS]):
+            return FOLLOWER, None
+        # claim 在我們加入前就結束了 (完成或失敗)，重新檢查
+    return OWNER, None
+
+
+def finish_inflight(key: str, job_id: str, result_json: Optional[str], raw_alias_keys: List[str] = ()) -> List[str]:
+    """
+    job_id 的推論結束 (result_json 為 None 表示失敗)：先寫入快取再釋放 claim 並取出等待中的任務，回傳它們的 job ID。
+    claim 已被其他任務接手時不會取出等待者 (由新的負責者寫回)，重複呼叫也不影響別人的 claim。
+    """
+    if result_json is not None:
+        store_cached_result(key, result_json, raw_alias_keys)
+    followers = _release_claim(key, job_id)
+    if result_json is not None:
+        set_raw_aliases(key, [follower["raw_alias_key"] for follower in followers])
+    return [follower["job_id"] for follower in followers]
+
+
+def reap_orphaned_followers() -> List[str]:
+    """
+    找出負責推論的 Worker 已離線 (心跳消失) 或 claim 已逾時的等待者，釋放 claim 並回傳它們的 job ID，
+    由呼叫端標記為失敗 (音訊在取出佇列時已刪除，無法重新排入)。
+    """
+    orphaned = []
+    for followers_key in redis_client.scan_iter(match=FOLLOWERS_KEY_PREFIX + "*"):
+        key = followers_key.decode("utf-8")[len(FOLLOWERS_KEY_PREFIX):]
+        claim = redis_client.get(INFLIGHT_KEY_PREFIX + key)
+        if claim is not None:
+            claim = json.loads(claim)
+            if _owner_alive(claim):
+                continue
+        orphaned.extend(follower["job_id"] for follower in _release_claim(key, claim["job_id"] if claim else ""))
+    return orphaned
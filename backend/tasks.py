@@ -1,177 +1,399 @@
-import librosa
-import torch
-from celery import Celery
-from whistress import WhiStressInferenceClient
 import os
 import json # 用於儲存複雜的結果到 Redis
-from pydub import AudioSegment
-import tempfile
-from celery.schedules import timedelta # 用於 Celery Beat 的時間排程
-import numpy as np # 用於處理 audio_array
-import redis # 需要安裝 pip install redis
-import base64
-import uuid
-from celery.result import AsyncResult
-
-# --- Celery 配置 ---
-# BROKER_URL 指向你的 Redis 服務
-CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
-# RESULT_BACKEND 用於儲存任務結果，也指向 Redis
-CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
-
-celery_app = Celery(
-    'whistress_tasks',
-    broker=CELERY_BROKER_URL,
-    backend=CELERY_RESULT_BACKEND
+from celery_app import celery_app # Celery 設定與 API 共用 (不含模型相關的匯入)
+from audio_decoding import preprocess_audio, TARGET_SAMPLING_RATE
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
+from job_queue import (
+    redis_client, REDIS_BATCH_QUEUE_KEY, fetch_audio_blobs, publish_job_event,
+    WORKER_HEARTBEAT_INTERVAL_SECONDS, publish_worker_heartbeat, clear_worker_heartbeat,
 )
-
-# Celery 配置的更動
-celery_app.conf.update(
-    task_serializer='pickle', # 支持 bytes 數據傳輸
-    accept_content=['json', 'pickle'],
-    result_serializer='json', # 結果序列化為 JSON
-    timezone='Asia/Taipei',
-    enable_utc=True,
-    worker_prefetch_multiplier=1, # 確保 Worker 不會預先抓取太多任務
-    task_time_limit=3600, # 任務時間限制
-    task_soft_time_limit=3000, # 軟時間限制
-
-    # Celery Beat 配置，用於定期觸發批次處理任務
-    beat_schedule={
-        'process-pending-batch-every-5-seconds': {
-            'task': 'tasks.process_pending_batch_task', # 指向新任務
-            'schedule': timedelta(seconds=0.5), # 每 0.5 秒觸發一次
-        },
-    },
+import multiprocessing
+from celery.signals import worker_ready, worker_shutdown # 用於在 Worker 啟動時開啟批次消費迴圈
+import threading
+import socket
+import time
+from batching import BatchLimits, form_batches, should_dispatch
+from inference_replicas import InferenceReplicaPool, create_inference_client, compile_static_shapes, warm_up_model
+from result_cache import (
+    CACHED, FOLLOWER, result_cache_enabled, publish_model_fingerprint, cache_key_for_audio,
+    raw_audio_alias_key, claim_or_follow, finish_inflight, set_raw_aliases, reap_orphaned_followers,
 )
 
+# --- Worker 狀態 (透過心跳回報給 API 的 /ready 端點) ---
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+worker_status = {
+    "model_loaded": False,
+    "warmed": False, # 已完成啟動時的暖機批次
+    "ready": False, # 模型已載入 (並完成暖機)，消費迴圈已開始接收任務
+    "device": None,
+    "consumer_threads": 0,
+    "compiled_buckets": None, # torch.compile 各 bucket 的統計 (WHISTRESS_COMPILE)
+}
+
+# --- 推論 replica ---
+# 大於 0 時，Worker 啟動這麼多個推論 process (見 inference_replicas.py)，每個有固定的推論執行緒數，
+# 批次交給閒置的 replica；0 表示在 Worker 進程內直接推論。
+INFERENCE_REPLICAS = int(os.getenv("WHISTRESS_INFERENCE_REPLICAS", "0"))
+# 每個 replica 的推論執行緒數，預設平分 CPU；在進程內推論時只有設定了才套用
+THREADS_PER_REPLICA = os.getenv("WHISTRESS_THREADS_PER_REPLICA")
+
+# --- 推論引擎與模式 ---
+# WHISTRESS_ENGINE=onnx 使用 export_onnx.py 匯出的 ONNX Runtime graph (Worker 不需要 torch)
+INFERENCE_ENGINE = os.getenv("WHISTRESS_ENGINE", "torch")
+# 以下選項傳給 WhiStressInferenceClient (只適用於 torch 引擎)
+# WHISTRESS_QUANTIZATION=int8 在 CPU 上以動態 int8 量化 backbone 的線性層，WHISTRESS_QUANTIZE_HEAD=1 連同 stress head 一起量化
+CLIENT_OPTIONS = {
+    "quantization": os.getenv("WHISTRESS_QUANTIZATION") or None,
+    "quantize_head": os.getenv("WHISTRESS_QUANTIZE_HEAD", "0") == "1",
+    # WHISTRESS_COMPILE=inductor (或其他 torch.compile backend) 將輸入補齊到固定的 (batch, length) bucket，
+    # 以編譯過的 graph 執行 encoder、prompt 評分與 stress head；graph 在 Worker 啟動時編譯 (不受暖機設定影響)
+    "compile_backend": os.getenv("WHISTRESS_COMPILE") or None,
+    # WHISTRESS_PRECISION=bf16 以 bfloat16 執行矩陣乘法 (需支援 bf16 的 CPU，例如較新的 Xeon)，不可與 int8 量化併用
+    "precision": os.getenv("WHISTRESS_PRECISION") or None,
+}
+
+def mark_inference_unavailable():
+    """
+    所有推論 replica 都已結束且無法重啟：不再回報 ready，消費迴圈停止從佇列取項目，
+    讓其他 Worker 處理。
+    """
+    print("No inference replica left; this worker stops taking jobs.")
+    worker_status["ready"] = False
+
+
 # --- 模型載入 (在 Celery Worker 啟動時載入) ---
 # 這裡確保模型在每個 Worker 進程中載入一次
-whistress_client: WhiStressInferenceClient = None
+whistress_client = None
 def get_whistress_client():
     global whistress_client
     if whistress_client is None:
-        print("Loading WhiStress model for Celery Worker...")
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        whistress_client = WhiStressInferenceClient(device=device)
+        if INFERENCE_REPLICAS > 0:
+            threads_per_replica = int(THREADS_PER_REPLICA or max(1, (os.cpu_count() or 1) // INFERENCE_REPLICAS))
+            print(f"Starting {INFERENCE_REPLICAS} WhiStress inference replicas for Celery Worker...")
+            # 暖機在每個 replica 內進行
+            whistress_client = InferenceReplicaPool(
+                INFERENCE_REPLICAS, threads_per_replica, WARMUP_BATCH_SIZES, WARMUP_AUDIO_SECONDS, CLIENT_OPTIONS,
+                engine=INFERENCE_ENGINE, on_unavailable=mark_inference_unavailable,
+            )
+            device = whistress_client.device
+            worker_status["warmed"] = whistress_client.warmed
+        else:
+            print(f"Loading WhiStress model ({INFERENCE_ENGINE}) for Celery Worker...")
+            whistress_client = create_inference_client(
+                INFERENCE_ENGINE, int(THREADS_PER_REPLICA) if THREADS_PER_REPLICA else None, CLIENT_OPTIONS
+            )
+            device = whistress_client.device
         print(f"WhiStress model loaded successfully on {device} for Celery Worker.")
+        worker_status.update(model_loaded=True, device=device)
+        if result_cache_enabled():
+            # API 端用模型指紋計算快取別名，換了權重就不會命中舊結果
+            publish_model_fingerprint(whistress_client.model_fingerprint)
     return whistress_client
 
-# --- Redis 客戶端用於共享批次佇列 ---
-# 使用不同的 DB，以防與 Celery 的 broker/backend 衝突
-redis_client = redis.StrictRedis(host='localhost', port=6379, db=1)
-REDIS_BATCH_QUEUE_KEY = "whistress_inference_batch_queue"
-BATCH_SIZE_THRESHOLD = 4 # 你希望的批次大小
-
-# <--- 新增一個直接連接到 Celery backend (DB 0) 的 Redis 客戶端 ---
-# 這將用於在 Celery Worker 內部直接驗證 DB 0 的寫入
-redis_backend_test_conn = redis.StrictRedis(host='localhost', port=6379, db=0)
-# -------------------------------------------------------------------
-
-# --- 新增的測試任務 ---
-# 這個任務僅用於測試 Fast API 的 Celery 後端讀取能力
-@celery_app.task(name="test_fastapi_backend_read")
-def test_fastapi_backend_read(value):
-    return f"Test value received: {value}"
-# ---------------------
-
-# --- 定義 Celery 任務 ---
-@celery_app.task(bind=True)
-def analyze_stress_task(self, audio_bytes: bytes, prompt_text: str = None):
-    """
-    Celery 任務：接收音頻二進制數據和引導文本，進行重音模式分析。
-    """
-    #3
-    # --- 1. 修改 analyze_stress_task 為批次收集器 ---
-    # 為了 JSON 序列化，將 bytes 轉換為 base64 字串
-    # json 不直接支持 bytes 類型
-    print("INFO: Attempting to base64 encode audio bytes...")
-    audio_base64 = base64.b64encode(audio_bytes).decode('utf-8')
-    print("INFO: Successfully base64 encoded audio data.")
-    new_id = str(uuid.uuid4())
-    print(f"task_result_new_id-----------------{new_id}")
-    task_data = {
-        "audio_base64": audio_base64, # 儲存 base64 編碼的音頻數據
-        "prompt_text": prompt_text,
-        "original_task_id": new_id#self.request.id # 保存原始任務的 ID
-    }
-    
-    # 將任務數據推送到 Redis 列表的左側 (作為 FIFO 佇列)
-    redis_client.lpush(REDIS_BATCH_QUEUE_KEY, json.dumps(task_data))
-    print(f"Task {self.request.id} added to Redis batch queue. Current queue length: {redis_client.llen(REDIS_BATCH_QUEUE_KEY)}")
-    
-    # 立即返回，告訴客戶端任務已提交到批次隊列
-    return {"status": "SUBMITTED_TO_BATCH", "batch_task_id": new_id , "message": "Task submitted to batch queue for processing."}
-
-# --- 2. 新增批次處理任務 ---
-@celery_app.task(bind=True)    
-def process_pending_batch_task(self):
-    """
-    Celery Beat 定期觸發的任務：從 Redis 佇列中取出待處理的任務，執行批次推論。
-    """
-    # 獲取推理客戶端 (確保模型只在需要時載入一次)
+# --- Redis 客戶端用於共享批次佇列 (見 job_queue.py) ---
+
+# --- 批次組成設定 (依計算預算切批次，而不是固定 4 筆) ---
+BATCH_LIMITS = BatchLimits(
+    max_batch_size=int(os.getenv("WHISTRESS_BATCH_MAX_SIZE", "16")),
+    max_audio_seconds=float(os.getenv("WHISTRESS_BATCH_MAX_AUDIO_SECONDS", "240")),
+    max_prompt_tokens=int(os.getenv("WHISTRESS_BATCH_MAX_PROMPT_TOKENS", "1024")),
+    max_wait_seconds=float(os.getenv("WHISTRESS_BATCH_MAX_WAIT_SECONDS", "0.05")),
+)
+# 每次最多從佇列取出的項目數，取出後再依長度分成多個批次
+BATCH_POP_LIMIT = int(os.getenv("WHISTRESS_BATCH_POP_LIMIT", str(BATCH_LIMITS.max_batch_size * 4)))
+# 消費迴圈阻塞等待佇列的秒數 (逾時後檢查是否需要停止，再繼續等待)
+CONSUMER_BLOCK_TIMEOUT = int(os.getenv("WHISTRESS_CONSUMER_BLOCK_TIMEOUT", "5"))
+# 使用推論 replica 時預設每個 replica 一個消費迴圈，讓前處理與取佇列跟得上
+CONSUMER_THREADS = int(os.getenv("WHISTRESS_CONSUMER_THREADS", str(max(1, INFERENCE_REPLICAS))))
+# 音訊前處理 (解碼、重新取樣、正規化) 的 process 數，與推論執行緒分開設定
+PREPROCESS_WORKERS = int(os.getenv("WHISTRESS_PREPROCESS_WORKERS", str(max(1, (os.cpu_count() or 4) // 4))))
+
+# --- 啟動暖機 ---
+# Worker 啟動時就載入模型，並以假音訊對每個批次大小跑一次 (有/無 prompt 兩種路徑)，
+# 讓 CUDA kernel、allocator 快取等在第一個真正的請求前就緒。設為空字串可停用暖機。
+def _default_warmup_batch_sizes(max_batch_size: int) -> str:
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_batch_size)
+    return ",".join(str(size) for size in sizes)
+
+WARMUP_BATCH_SIZES = [
+    int(size) for size in os.getenv(
+        "WHISTRESS_WARMUP_BATCH_SIZES", _default_warmup_batch_sizes(BATCH_LIMITS.max_batch_size)
+    ).split(",") if size.strip()
+]
+WARMUP_AUDIO_SECONDS = float(os.getenv("WHISTRESS_WARMUP_AUDIO_SECONDS", "1"))
+# torch.compile 的批次 bucket，預設與暖機的批次大小相同；超過最大 bucket 的批次以 eager 模式執行
+if CLIENT_OPTIONS["compile_backend"]:
+    CLIENT_OPTIONS["compile_batch_buckets"] = [
+        int(size) for size in os.getenv(
+            "WHISTRESS_COMPILE_BATCH_BUCKETS", _default_warmup_batch_sizes(BATCH_LIMITS.max_batch_size)
+        ).split(",") if size.strip()
+    ]
+
+# --- 音訊前處理 process pool (在 Worker 中載入一次) ---
+preprocess_pool: ProcessPoolExecutor = None
+def get_preprocess_pool():
+    global preprocess_pool
+    if preprocess_pool is None:
+        # 使用 spawn：子程序只需匯入 audio_decoding，不繼承已載入 torch 的 Worker 狀態
+        preprocess_pool = ProcessPoolExecutor(
+            max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+        print(f"Audio preprocessing pool started with {PREPROCESS_WORKERS} processes.")
+    return preprocess_pool
+
+
+
+# --- 1. 批次佇列 ---
+# API 直接以 job_queue.enqueue_job 將任務寫入批次佇列 (不再經過一個 Celery 任務轉手)，
+# 結果以同一個 job ID 寫入 Celery backend。
+
+def store_job_result(job_id: str, result_json: str):
+    """
+    將結果寫入 Celery backend，並通知等待中的 SSE 連線。
+    """
+    celery_app.backend.store_result(job_id, result_json, state='SUCCESS')
+    publish_job_event(job_id, {"status": "COMPLETED", "result": json.loads(result_json)})
+
+
+def store_job_failure(job_id: str, error_message: str):
+    # Celery backend 需要例外物件 (純字串無法被 get_task_meta 解碼)
+    celery_app.backend.mark_as_failure(job_id, RuntimeError(error_message))
+    publish_job_event(job_id, {"status": "FAILED", "error": error_message})
+
+# --- 2. 批次消費迴圈 ---
+consumer_stop_event = threading.Event()
+consumer_threads: list = []
+# Worker 關閉時等待消費迴圈處理完手上項目的最長秒數
+CONSUMER_SHUTDOWN_TIMEOUT = float(os.getenv("WHISTRESS_CONSUMER_SHUTDOWN_TIMEOUT_SECONDS", "60"))
+
+def collect_batch_items(first_item: dict) -> list:
+    """
+    從第一個項目開始收集：佇列足以填滿一個批次，或第一個項目等待超過 max_wait_seconds 就結束。
+    """
+    items = [first_item]
+    started_at = first_item.get("enqueued_at", time.time())
+    while len(items) < BATCH_POP_LIMIT:
+        # 先把佇列中已有的項目一次取出
+        more = redis_client.rpop(REDIS_BATCH_QUEUE_KEY, BATCH_POP_LIMIT - len(items)) or []
+        items.extend(json.loads(item_json) for item_json in more)
+        if should_dispatch(len(items), started_at, BATCH_LIMITS):
+            break
+        # 佇列已空，阻塞等待下一個項目直到期限 (timeout 為 0 代表永久阻塞，所以要先檢查)
+        remaining = started_at + BATCH_LIMITS.max_wait_seconds - time.time()
+        if remaining <= 0:
+            break
+        popped = redis_client.brpop(REDIS_BATCH_QUEUE_KEY, timeout=remaining)
+        if popped is None:
+            break
+        items.append(json.loads(popped[1]))
+    return items
+
+
+def batch_consumer_loop(stop_event: threading.Event = consumer_stop_event):
+    """
+    Worker 內長時間執行的消費迴圈：阻塞等待 Redis 批次佇列，第一個項目到達就開始組批次，
+    依大小或期限結束後立即推論。取代原本每 0.5 秒由 Celery Beat 觸發的輪詢。
+    """
     client = get_whistress_client()
+    print("Batch consumer loop started.")
+    # 雙緩衝：目前這組在推論時，下一組已在 process pool 中解碼
+    prepared_items = None
+    while not stop_event.is_set() and worker_status["ready"]:
+        current_items = None
+        try:
+            if prepared_items is None:
+                popped = redis_client.brpop(REDIS_BATCH_QUEUE_KEY, timeout=CONSUMER_BLOCK_TIMEOUT)
+                if popped is None:
+                    continue # 逾時，回頭檢查 stop_event
+                prepared_items = submit_preprocessing(collect_batch_items(json.loads(popped[1])))
+
+            # 推論前先把佇列中已經在等的項目送去前處理 (不阻塞)
+            next_items = redis_client.rpop(REDIS_BATCH_QUEUE_KEY, BATCH_POP_LIMIT) or []
+            next_prepared_items = (
+                submit_preprocessing([json.loads(item_json) for item_json in next_items]) if next_items else None
+            )
+
+            current_items, prepared_items = prepared_items, next_prepared_items
+            process_batch_items(client, current_items)
+        except Exception as e:
+            # 不讓單次錯誤 (例如 Redis 暫時斷線) 結束整個迴圈
+            print(f"Error in batch consumer loop: {e}")
+            if current_items:
+                # 已從佇列取出的項目不能留在 PENDING，也不能讓它們的 claim 擋住相同內容的請求
+                fail_popped_items(current_items, f"Batch processing failed: {e}")
+            time.sleep(1)
+    if prepared_items:
+        # 預先取出的這組已離開佇列 (音訊也已刪除)，停止時也不能留在 PENDING：
+        # 先處理完 (推論失敗時 run_inference_batch 會將它們標記為失敗)，無法處理時標記為失敗並釋放 claim
+        try:
+            process_batch_items(client, prepared_items)
+        except Exception as e:
+            print(f"Error processing prefetched items on stop: {e}")
+            fail_popped_items(prepared_items, f"Worker stopped before the job was processed: {e}")
+    print("Batch consumer loop stopped.")
+
 
-    items_to_process = []
-    
-    # 原子性地從 Redis 佇列中取出多個元素
-    # 嘗試取出 BATCH_SIZE_THRESHOLD 數量或佇列中所有元素
-    # rpop 命令從列表的右側彈出元素，lpush 是從左側推入。
-    # FIFO (先進先出)，lpush 和 rpop。
-
-    # 使用 Pipeline 實現原子性地批量拉取
-    pipe = redis_client.pipeline()
-    for _ in range(BATCH_SIZE_THRESHOLD):
-        pipe.rpop(REDIS_BATCH_QUEUE_KEY)
-    results = pipe.execute()
-    for item_json in results:
-        if item_json is None:
-            continue # 佇列已空或未達批次大小
-        items_to_process.append(json.loads(item_json))
-
-    if not items_to_process:
-        print("No pending tasks in batch queue to process.")
+def fail_popped_items(prepared_items: list, error_message: str):
+    """
+    batch_consumer_loop 出錯時：將這組項目中尚未完成的任務標記為失敗，並釋放它們持有的 claim
+    (等待相同結果的任務一併失敗)。等待其他任務結果的項目不動。
+    """
+    for item, _ in prepared_items:
+        try:
+            if item.get("following"):
+                continue
+            job_ids = [item["original_task_id"]]
+            if item.get("cache_key"):
+                job_ids.extend(finish_inflight(item["cache_key"], item["original_task_id"], None))
+            for job_id in job_ids:
+                if celery_app.backend.get_task_meta(job_id).get("status") not in ["SUCCESS", "FAILURE"]:
+                    store_job_failure(job_id, error_message)
+        except Exception as e:
+            print(f"Failed to mark task {item['original_task_id']} as failed: {e}")
+
+
+def worker_heartbeat_loop(stop_event: threading.Event = consumer_stop_event):
+    """
+    定期把 worker_status 寫入 Redis (有 TTL)，讓 API 知道這個 Worker 還活著以及模型是否已載入。
+    """
+    while not stop_event.is_set():
+        try:
+            if whistress_client is not None:
+                worker_status["compiled_buckets"] = whistress_client.bucket_stats()
+                if result_cache_enabled():
+                    # 指紋隨心跳更新，Worker 離線後 API 不再以它計算別名
+                    publish_model_fingerprint(whistress_client.model_fingerprint)
+            publish_worker_heartbeat(WORKER_ID, worker_status)
+            if result_cache_enabled():
+                # 等待的相同請求已由離線的 Worker 負責 (或已逾時)，不讓它們永遠停在 PENDING
+                for job_id in reap_orphaned_followers():
+                    store_job_failure(job_id, "The identical request this job was waiting for was lost; please retry.")
+        except Exception as e:
+            print(f"Failed to publish worker heartbeat: {e}")
+        stop_event.wait(WORKER_HEARTBEAT_INTERVAL_SECONDS)
+
+
+def start_worker(stop_event: threading.Event = consumer_stop_event):
+    """
+    載入模型並暖機，完成後才標記為 ready 並開始消費迴圈。
+    """
+    client = get_whistress_client()
+    # 使用推論 replica 時，各 replica 在啟動時自行編譯與暖機
+    if INFERENCE_REPLICAS == 0:
+        compile_static_shapes(client)
+        if WARMUP_BATCH_SIZES:
+            try:
+                warm_up_model(client, WARMUP_BATCH_SIZES, WARMUP_AUDIO_SECONDS)
+                worker_status["warmed"] = True
+            except Exception as e:
+                # 暖機失敗不影響正常服務，只是第一個請求會比較慢
+                print(f"Model warm-up failed: {e}")
+    if stop_event.is_set():
         return
+    worker_status.update(ready=True, consumer_threads=CONSUMER_THREADS)
+    for i in range(CONSUMER_THREADS):
+        thread = threading.Thread(
+            target=batch_consumer_loop, name=f"whistress-batch-consumer-{i}", daemon=True
+        )
+        thread.start()
+        consumer_threads.append(thread)
+
 
-    print(f"Processing batch of {len(items_to_process)} items.")
+@worker_ready.connect
+def start_batch_consumers(**kwargs):
+    threading.Thread(target=worker_heartbeat_loop, name="whistress-worker-heartbeat", daemon=True).start()
+    # 在背景載入模型與暖機，不阻塞 Celery 的啟動流程；進度透過心跳回報
+    threading.Thread(target=start_worker, name="whistress-worker-startup", daemon=True).start()
+
+
+@worker_shutdown.connect
+def stop_batch_consumers(**kwargs):
+    consumer_stop_event.set()
+    # 等消費迴圈把已取出的項目處理完 (或標記為失敗) 再關閉心跳與推論 replica，
+    # 在這之前其他 Worker 不會接手這個 Worker 的 claim
+    deadline = time.time() + CONSUMER_SHUTDOWN_TIMEOUT
+    for thread in consumer_threads:
+        thread.join(max(0, deadline - time.time()))
+    try:
+        clear_worker_heartbeat(WORKER_ID)
+    except Exception as e:
+        print(f"Failed to clear worker heartbeat: {e}")
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown(wait=False, cancel_futures=True)
+    if isinstance(whistress_client, InferenceReplicaPool):
+        whistress_client.shutdown()
+
+
+def submit_preprocessing(items: list) -> list:
+    """
+    以一次 MGET 取回這組項目的音訊，送到前處理 process pool，回傳 (item, future) 列表。
+    """
+    pool = get_preprocess_pool()
+    audio_blobs = fetch_audio_blobs([item["original_task_id"] for item in items])
+    prepared_items = []
+    for item, audio_bytes in zip(items, audio_blobs):
+        if audio_bytes is None:
+            # 音訊已過期或不存在，讓 process_batch_items 將任務標記為失敗
+            future = Future()
+            future.set_exception(ValueError("Audio data expired or missing."))
+        else:
+            future = pool.submit(preprocess_audio, audio_bytes, TARGET_SAMPLING_RATE)
+            if result_cache_enabled():
+                item["raw_alias_key"] = raw_audio_alias_key(
+                    audio_bytes, item["prompt_text"], get_whistress_client().model_fingerprint
+                )
+        prepared_items.append((item, future))
+    return prepared_items
+
+
+def process_batch_items(client, prepared_items: list):
+    """
+    等待一組項目的前處理結果 (見 submit_preprocessing)，依長度分成多個批次並逐一推論。
+    """
+    print(f"Processing {len(prepared_items)} queued items.")
 
-    audio_dicts_for_model = []
-    prompt_texts_for_model = []
-    original_task_ids = []
     successful_items = []
     failed_task_ids = []
 
-    for item in items_to_process:
-        temp_in_path = None
-        temp_out_path = None
+    for item, future in prepared_items:
         try:
-            print("開始處理音訊")
-            audio_bytes = base64.b64decode(item["audio_base64"])
-
-            # --- 音頻轉換邏輯 ---
-            # 建立第一個臨時檔案 (.webm)
-            #with tempfile.NamedTemporaryFile(delete=False, suffix=".webm") as temp_in:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".input") as temp_in:
-                temp_in.write(audio_bytes)
-                temp_in.flush()
-                temp_in_path = temp_in.name
-
-            # 從 .webm 讀取並轉換為 .wav
-            #audio = AudioSegment.from_file(temp_in_path, format="webm")
-            audio = AudioSegment.from_file(temp_in_path)
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as temp_out:
-                audio.export(temp_out.name, format="wav")
-                temp_out_path = temp_out.name
-                
-                audio_array, sampling_rate = librosa.load(temp_out_path, sr=None)
+            # 已在 process pool 中解碼為 16kHz 單聲道 float32 並正規化
+            audio_array = future.result()
+
+            cache_key = None
+            if result_cache_enabled():
+                # 相同音訊與 prompt 已有結果就直接寫回；正在推論中就等它的結果
+                cache_key = cache_key_for_audio(audio_array, item["prompt_text"], client.model_fingerprint)
+                outcome, cached_result = claim_or_follow(
+                    cache_key, item["original_task_id"], WORKER_ID, item.get("raw_alias_key")
+                )
+                # batch_consumer_loop 出錯時依此釋放這個任務持有的 claim
+                item["cache_key"] = cache_key
+                if outcome == CACHED:
+                    set_raw_aliases(cache_key, [item.get("raw_alias_key")])
+                    store_job_result(item["original_task_id"], cached_result)
+                    print(f"Task {item['original_task_id']} served from result cache.")
+                    continue
+                if outcome == FOLLOWER:
+                    item["following"] = True
+                    print(f"Task {item['original_task_id']} is waiting for an identical in-flight request.")
+                    continue
 
             # 成功處理，將結果添加到列表中
             successful_items.append({
                 "original_task_id": item["original_task_id"],
                 "prompt_text": item["prompt_text"],
+                "cache_key": cache_key,
+                "raw_alias_key": item.get("raw_alias_key"),
+                "duration": len(audio_array) / TARGET_SAMPLING_RATE,
                 "audio_dict": {
                     "array": audio_array,
-                    "sampling_rate": sampling_rate
+                    "sampling_rate": TARGET_SAMPLING_RATE
                 }
             })
 
@@ -179,35 +401,45 @@ def process_pending_batch_task(self):
             # 處理單個音頻轉換失敗
             error_message = f"Audio conversion failed for task {item['original_task_id']}: {e}"
             print(error_message)
-            celery_app.backend.mark_as_failure(item['original_task_id'], error_message)
+            store_job_failure(item['original_task_id'], error_message)
             # 將失敗的任務ID記錄下來
             failed_task_ids.append(item['original_task_id'])
 
-        finally:
-            # 無論成功或失敗，都嘗試清理臨時檔案
-            if temp_in_path and os.path.exists(temp_in_path):
-                os.unlink(temp_in_path)
-            if temp_out_path and os.path.exists(temp_out_path):
-                os.unlink(temp_out_path)
-
-    # 在迴圈結束後，統一從 successful_items 建立批次列表
-    if successful_items:
-        original_task_ids = [i["original_task_id"] for i in successful_items]
-        prompt_texts_for_model = [i["prompt_text"] for i in successful_items]
-        audio_dicts_for_model = [i["audio_dict"] for i in successful_items]
+    if not successful_items:
+        print("WARNING: No tasks in the batch need inference (failed to convert or answered from cache).")
+        return
+
+    # 依長度與 prompt 長度分成多個批次；有推論 replica 時同時送出，由閒置的 replica 處理，否則逐一推論
+    batches = form_batches(successful_items, BATCH_LIMITS)
+    print(f"Formed {len(batches)} batches: {[len(b) for b in batches]}")
+    if isinstance(client, InferenceReplicaPool) and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(batches), INFERENCE_REPLICAS)) as executor:
+            outcomes = list(executor.map(lambda batch: run_inference_batch(client, batch), batches))
     else:
-        print("WARNING: All tasks in the batch failed to convert. No batch inference will be performed.")
+        outcomes = [run_inference_batch(client, batch) for batch in batches]
+    failed_batches = outcomes.count(False)
+    if failed_batches:
+        return {"status": "FAILED", "message": f"{failed_batches} of {len(batches)} batches failed."}
+    return {"status": "COMPLETED", "message": "All items in batch processed."}
+
+
+def run_inference_batch(client, batch_items: list) -> bool:
+    """
+    對一個已組好的批次執行推論，並將每個原始任務的結果寫回 Celery 後端。
+    成功回傳 True，失敗時將批次中的任務標記為失敗並回傳 False。
+    """
+    original_task_ids = [i["original_task_id"] for i in batch_items]
+    audio_dicts_for_model = [i["audio_dict"] for i in batch_items]
+    # 同一批次中的項目不是全部有 prompt 就是全部沒有 (見 form_batches)
+    prompt_texts_for_model = [i["prompt_text"] for i in batch_items] if batch_items[0]["prompt_text"] else None
 
-    if not audio_dicts_for_model:
-        print("No valid audio to process in this batch after conversion.")
-        return
-    
     try:
         # 調用客戶端的批次推論方法
         batch_processed_results = client.predict_batch(
             audio_list=audio_dicts_for_model, 
             transcription_list=prompt_texts_for_model,
-            return_pairs=False # 這裡讓它返回格式化的結果，方便直接儲存
+            return_pairs=False, # 這裡讓它返回格式化的結果，方便直接儲存
+            audio_prepared=True, # 前處理 pool 已完成重新取樣與正規化
         )
 
         # 將每個原始任務的結果寫回 Celery 後端
@@ -222,27 +454,31 @@ def process_pending_batch_task(self):
             }
             print(f"DEBUG: 準備寫入 Redis 的最終結果: {formatted_result}")
             print(f"新ID: {original_task_id}")
-            celery_app.backend.store_result(original_task_id, json.dumps(formatted_result), state='SUCCESS')
-            '''
-            checked_task_result = AsyncResult(original_task_id, app=celery_app)
-            print(f"DEBUG: WORKER SELF-CHECK: 任務 {original_task_id} - 狀態: {checked_task_result.state}")
-            print(f"DEBUG: WORKER SELF-CHECK: 任務 {original_task_id} - 結果: {checked_task_result.result}")
-            print(f"DEBUG: WORKER SELF-CHECK: 任務 {original_task_id} - 結果類型: {type(checked_task_result.result)}")
-            '''
+            result_json = json.dumps(formatted_result)
+            store_job_result(original_task_id, result_json)
             print(f"Marked original task {original_task_id} as COMPLETED with result.")
-        return {"status": "COMPLETED", "message": "All items in batch processed."} 
+            if batch_items[i]["cache_key"]:
+                # 寫入快取，並把結果一併寫給等待中的相同請求
+                for follower_id in finish_inflight(
+                    batch_items[i]["cache_key"], original_task_id, result_json, [batch_items[i]["raw_alias_key"]]
+                ):
+                    store_job_result(follower_id, result_json)
+        return True
     except Exception as e:
         try:
             error_message = f"Batch analysis failed: {e}"
             print(f"Error in batch processing task: {error_message}")
+            # 等待相同內容結果的任務也一併失敗
+            for item in batch_items:
+                if item["cache_key"]:
+                    original_task_ids.extend(finish_inflight(item["cache_key"], item["original_task_id"], None))
             # 標記批次中所有仍在 PENDING 狀態的原始任務為失敗
             for original_task_id in original_task_ids:
                 # 僅更新那些尚未被標記為成功的任務
                 task_meta = celery_app.backend.get_task_meta(original_task_id)
                 current_status = task_meta.get('status')
                 if current_status not in ["SUCCESS", "FAILURE"]:
-                    celery_app.backend.mark_as_failure(original_task_id, error_message)
+                    store_job_failure(original_task_id, error_message)
         except Exception as update_e:
             print(f"Failed to update status for task {original_task_id}: {update_e}")
-        self.update_state(state='FAILURE', meta={'exc_type': type(e).__name__, 'exc_message': str(e)})
-    return {"status": "FAILED", "message": "All items in batch processed."} 
\ No newline at end of file
+        return False
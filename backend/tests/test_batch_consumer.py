@@ -0,0 +1,108 @@
+import json
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+import job_queue
+import tasks
+
+
+class FakeBackend:
+    def __init__(self):
+        self.states = {}
+
+    def store_result(self, job_id, result, state):
+        self.states[job_id] = state
+
+    def mark_as_failure(self, job_id, exc):
+        self.states[job_id] = "FAILURE"
+
+    def get_task_meta(self, job_id):
+        return {"status": self.states.get(job_id, "PENDING")}
+
+
+class StoppingClient:
+    """
+    Sets stop_event during the first batch, so the consumer loop stops while the
+    next batch has already been popped and sent to preprocessing.
+    """
+
+    model_fingerprint = "test"
+
+    def __init__(self, stop_event):
+        self.stop_event = stop_event
+        self.batches = []
+
+    def predict_batch(self, audio_list, transcription_list, return_pairs, audio_prepared):
+        self.batches.append(len(audio_list))
+        self.stop_event.set()
+        return [("a b", [0, 1]) for _ in audio_list]
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    redis_client = fakeredis.FakeStrictRedis()
+    backend = FakeBackend()
+    preprocess_pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(job_queue, "redis_client", redis_client)
+    monkeypatch.setattr(tasks, "redis_client", redis_client)
+    monkeypatch.setattr(tasks, "celery_app", types.SimpleNamespace(backend=backend))
+    monkeypatch.setattr(tasks, "publish_job_event", lambda job_id, event: None)
+    monkeypatch.setattr(tasks, "result_cache_enabled", lambda: False)
+    monkeypatch.setattr(tasks, "get_preprocess_pool", lambda: preprocess_pool)
+    monkeypatch.setattr(tasks, "preprocess_audio", lambda audio_bytes, sampling_rate: np.zeros(16000, np.float32))
+    # one item per pop: the first job is the current batch, the second one is prefetched
+    monkeypatch.setattr(tasks, "BATCH_POP_LIMIT", 1)
+    monkeypatch.setitem(tasks.worker_status, "ready", True)
+    job_queue.enqueue_jobs([(f"job-{i}", b"audio", None) for i in range(3)])
+    yield redis_client, backend
+    preprocess_pool.shutdown()
+
+
+def run_consumer(monkeypatch, client, stop_event):
+    monkeypatch.setattr(tasks, "get_whistress_client", lambda: client)
+    thread = threading.Thread(target=tasks.batch_consumer_loop, args=(stop_event,))
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+
+
+def popped_job_states(redis_client, backend):
+    queued = {json.loads(item)["original_task_id"] for item in redis_client.lrange(tasks.REDIS_BATCH_QUEUE_KEY, 0, -1)}
+    return {job_id: backend.get_task_meta(job_id)["status"] for job_id in ["job-0", "job-1", "job-2"] if job_id not in queued}
+
+
+def test_prefetched_batch_is_processed_on_stop(worker, monkeypatch):
+    redis_client, backend = worker
+    stop_event = threading.Event()
+    client = StoppingClient(stop_event)
+    run_consumer(monkeypatch, client, stop_event)
+
+    states = popped_job_states(redis_client, backend)
+    assert states == {"job-0": "SUCCESS", "job-1": "SUCCESS"}
+    assert client.batches == [1, 1]
+    # the job that was never popped is still queued for another worker
+    assert redis_client.llen(tasks.REDIS_BATCH_QUEUE_KEY) == 1
+
+
+def test_prefetched_batch_is_failed_when_it_cannot_be_processed(worker, monkeypatch):
+    redis_client, backend = worker
+    stop_event = threading.Event()
+    client = StoppingClient(stop_event)
+    form_batches = tasks.form_batches
+
+    def form_batches_until_stopped(items, limits):
+        if stop_event.is_set():
+            raise RuntimeError("inference is shutting down")
+        return form_batches(items, limits)
+
+    monkeypatch.setattr(tasks, "form_batches", form_batches_until_stopped)
+    run_consumer(monkeypatch, client, stop_event)
+
+    states = popped_job_states(redis_client, backend)
+    assert states == {"job-0": "SUCCESS", "job-1": "FAILURE"}
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+
+from whistress.inference_client.postprocessing import GENERATION_MAX_LENGTH, max_new_tokens_for_audio
+
+SAMPLING_RATE = 16000
+# fast conversational speech: 5 words/s at 1.75 Whisper BPE tokens per word (punctuation included)
+DENSE_SPEECH_TOKENS_PER_SECOND = 5 * 1.75
+
+
+def clip(seconds):
+    return np.zeros(int(seconds * SAMPLING_RATE), dtype=np.float32)
+
+
+@pytest.mark.parametrize("seconds", [1, 2.5, 5, 10, 15, 20])
+def test_dense_speech_is_not_cut_off(seconds):
+    # every transcript token plus the closing EOS must fit
+    needed = int(np.ceil(seconds * DENSE_SPEECH_TOKENS_PER_SECOND)) + 1
+    budget = max_new_tokens_for_audio([clip(seconds)])
+    assert budget >= min(needed, GENERATION_MAX_LENGTH - 2)
+
+
+def test_budget_follows_the_longest_clip_and_keeps_the_old_limit():
+    assert max_new_tokens_for_audio([clip(1), clip(10)]) == max_new_tokens_for_audio([clip(10)])
+    assert max_new_tokens_for_audio([clip(1)]) < max_new_tokens_for_audio([clip(10)])
+    # the fixed limit before the budget followed the audio length
+    assert max_new_tokens_for_audio([clip(60)]) == GENERATION_MAX_LENGTH - 2
@@ -1 +1,6 @@
-from .inference_client import WhiStressInferenceClient
\ No newline at end of file
+# imported lazily, so the ONNX Runtime client can be used without importing torch
+def __getattr__(name):
+    if name in ("WhiStressInferenceClient", "WhiStressOnnxClient"):
+        from . import inference_client
+        return getattr(inference_client, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1 +1,9 @@
-from .whistress_client import WhiStressInferenceClient
\ No newline at end of file
+# imported lazily: whistress_client needs torch, onnx_client needs onnxruntime
+def __getattr__(name):
+    if name == "WhiStressInferenceClient":
+        from .whistress_client import WhiStressInferenceClient
+        return WhiStressInferenceClient
+    if name == "WhiStressOnnxClient":
+        from .onnx_client import WhiStressOnnxClient
+        return WhiStressOnnxClient
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,53 @@
+import threading
+import numpy as np
+import torch
+
+
+class LogMelFrontEnd:
+    """
+    Batched replacement for ``feature_extractor(audio_list, return_tensors="pt")``
+    that runs on the inference device. Each clip is copied into a reused
+    waveform buffer, zero-padded (or cut) to 30 s. The STFT, mel projection and
+    log scaling then run as single tensor operations over the whole batch. The
+    Hann window and the mel filterbank are built once. The result matches
+    WhisperFeatureExtractor within float32 tolerance.
+    """
+
+    def __init__(self, feature_extractor, device="cpu"):
+        self.device = torch.device(device)
+        self.n_fft = feature_extractor.n_fft
+        self.hop_length = feature_extractor.hop_length
+        self.n_samples = feature_extractor.n_samples
+        self.window = torch.hann_window(self.n_fft, device=self.device)
+        # (n_mels, n_fft // 2 + 1)
+        self.mel_filters = torch.from_numpy(feature_extractor.mel_filters.T).float().contiguous().to(self.device)
+        # grown to the largest batch seen; one batch at a time uses it
+        self._waveforms = torch.empty(0, self.n_samples, device=self.device)
+        self._lock = threading.Lock()
+
+    def _fill_waveforms(self, audio_list):
+        batch_size = len(audio_list)
+        if self._waveforms.shape[0] < batch_size:
+            self._waveforms = torch.empty(batch_size, self.n_samples, device=self.device)
+        waveforms = self._waveforms[:batch_size]
+        for row, audio in zip(waveforms, audio_list):
+            length = min(len(audio), self.n_samples)
+            row[:length].copy_(torch.from_numpy(np.ascontiguousarray(audio[:length], dtype=np.float32)))
+            row[length:].zero_()
+        return waveforms
+
+    def __call__(self, audio_list):
+        """
+        Log-mel input features (batch, n_mels, frames) for a list of prepared 16 kHz clips.
+        """
+        # features stay fp32 even when the model runs under bf16 autocast
+        with self._lock, torch.no_grad(), torch.autocast(self.device.type, enabled=False):
+            waveforms = self._fill_waveforms(audio_list)
+            stft = torch.stft(
+                waveforms, self.n_fft, self.hop_length, window=self.window, return_complex=True
+            )
+            magnitudes = stft[..., :-1].abs() ** 2
+            log_spec = torch.clamp(self.mel_filters @ magnitudes, min=1e-10).log10()
+            # dynamic range of 8 (log10) below each clip's own maximum
+            log_spec = torch.maximum(log_spec, log_spec.amax(dim=(1, 2), keepdim=True) - 8.0)
+            return (log_spec + 4.0) / 4.0
@@ -0,0 +1,212 @@
+import json
+import pathlib
+import numpy as np
+import onnxruntime as ort
+from transformers import WhisperProcessor
+from .postprocessing import (
+    PROMPT_MAX_LENGTH,
+    PROMPT_LENGTH_BUCKETS,
+    bucketed_length,
+    get_word_emphasis_pairs,
+    max_new_tokens_for_audio,
+    prepare_audio,
+    word_level_stress,
+)
+from typing import Union, Dict, Optional, List
+
+# written by backend/export_onnx.py (see whistress/model/onnx_export.py for the graphs)
+PATH_TO_ONNX_MODEL = pathlib.Path(__file__).parent.parent / "weights" / "onnx"
+ONNX_ENCODER_FILENAME = "encoder.onnx"
+ONNX_DECODER_FILENAME = "decoder.onnx"
+ONNX_HEAD_FILENAME = "head.onnx"
+ONNX_SCORER_FILENAME = "scorer.onnx"
+ONNX_CONFIG_FILENAME = "whistress_onnx.json"
+
+
+class WhiStressOnnxClient:
+    """
+    Same predict / predict_prompts / predict_batch interface as WhiStressInferenceClient,
+    running the exported graphs on ONNX Runtime: the encoder once per clip, a greedy
+    decoding loop over the decoder graph with its KV cache, then the stress head.
+    Prompts are scored by a separate graph that stops the decoder at layer_for_head.
+    Needs neither torch nor the transformers model code, only the tokenizer and
+    feature extractor.
+    """
+
+    def __init__(self, onnx_dir=PATH_TO_ONNX_MODEL, providers=None, intra_op_num_threads=None):
+        self.onnx_dir = onnx_dir = pathlib.Path(onnx_dir)
+        with open(onnx_dir / ONNX_CONFIG_FILENAME) as f:
+            self.config = json.load(f)
+        self.processor = WhisperProcessor.from_pretrained(onnx_dir)
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads:
+            session_options.intra_op_num_threads = intra_op_num_threads
+        providers = providers or ["CPUExecutionProvider"]
+        self.encoder = ort.InferenceSession(str(onnx_dir / ONNX_ENCODER_FILENAME), session_options, providers=providers)
+        self.decoder = ort.InferenceSession(str(onnx_dir / ONNX_DECODER_FILENAME), session_options, providers=providers)
+        self.head = ort.InferenceSession(str(onnx_dir / ONNX_HEAD_FILENAME), session_options, providers=providers)
+        self.scorer = ort.InferenceSession(str(onnx_dir / ONNX_SCORER_FILENAME), session_options, providers=providers)
+        self.device = "cuda" if "CUDAExecutionProvider" in self.decoder.get_providers() else "cpu"
+        # exported with its own fingerprint: results may differ slightly from PyTorch
+        self.model_fingerprint = self.config["model_fingerprint"]
+
+        num_layers = self.config["num_layers"]
+        self._cross_names = [f"cross_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+        self._past_names = [f"past_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+        # the scorer takes the cross-attention states of the layers before layer_for_head only
+        # (and no attention mask when layer_for_head is 0: the exporter drops unused inputs)
+        self._scorer_inputs = {graph_input.name for graph_input in self.scorer.get_inputs()}
+        self._suppress_tokens = np.array(self.config["suppress_tokens"], dtype=np.int64)
+        self._begin_suppress_tokens = np.array(self.config["begin_suppress_tokens"], dtype=np.int64)
+
+    def bucket_stats(self):
+        # ONNX Runtime runs every shape with the same graphs; there are no compiled buckets
+        return None
+
+    def _encode(self, audio_list):
+        input_features = self.processor.feature_extractor(
+            audio_list, sampling_rate=16000, return_tensors="np"
+        )["input_features"].astype(np.float32)
+        encoder_hidden_states, *cross_key_values = self.encoder.run(None, {"input_features": input_features})
+        return encoder_hidden_states, cross_key_values
+
+    def _decode(self, input_ids, attention_mask, cross_key_values, past_key_values):
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask}
+        feeds.update(zip(self._cross_names, cross_key_values))
+        feeds.update(zip(self._past_names, past_key_values))
+        logits, decoder_hidden_states, *present_key_values = self.decoder.run(None, feeds)
+        return logits, decoder_hidden_states, present_key_values
+
+    def _empty_cache(self, batch_size):
+        shape = (batch_size, self.config["num_heads"], 0, self.config["head_dim"])
+        return [np.zeros(shape, dtype=np.float32) for _ in self._past_names]
+
+    def _generate(self, cross_key_values, max_new_tokens):
+        """
+        Greedy decoding as in WhiStress.generate_dual: the same decoder prompt,
+        suppressed tokens and EOS padding. Returns (sequences, decoder states at
+        layer_for_head for every position of the sequences).
+        """
+        batch_size = cross_key_values[0].shape[0]
+        eos_token_id = self.config["eos_token_id"]
+        sequences = np.tile(np.array(self.config["decoder_prompt_ids"], dtype=np.int64), (batch_size, 1))
+        input_ids = sequences
+        past_key_values = self._empty_cache(batch_size)
+        finished = np.zeros(batch_size, dtype=bool)
+        hidden_state_steps = []
+        for step in range(max_new_tokens):
+            attention_mask = np.ones((batch_size, sequences.shape[1]), dtype=np.int64)
+            logits, decoder_hidden_states, past_key_values = self._decode(
+                input_ids, attention_mask, cross_key_values, past_key_values
+            )
+            hidden_state_steps.append(decoder_hidden_states)
+            logits[:, self._suppress_tokens] = -np.inf
+            if step == 0:
+                logits[:, self._begin_suppress_tokens] = -np.inf
+            next_tokens = np.where(finished, self.config["pad_token_id"], logits.argmax(axis=-1))
+            sequences = np.concatenate([sequences, next_tokens[:, None]], axis=1)
+            finished |= next_tokens == eos_token_id
+            input_ids = next_tokens[:, None]
+            if finished.all():
+                break
+        # the last generated token is never fed back; one more step gives its states
+        attention_mask = np.ones((batch_size, sequences.shape[1]), dtype=np.int64)
+        _, decoder_hidden_states, _ = self._decode(input_ids, attention_mask, cross_key_values, past_key_values)
+        hidden_state_steps.append(decoder_hidden_states)
+        return sequences, np.concatenate(hidden_state_steps, axis=1)
+
+    def _tokenize(self, transcriptions):
+        tokenized = self.processor.tokenizer(
+            transcriptions, return_tensors="np", padding="longest", truncation=True, max_length=PROMPT_MAX_LENGTH
+        )
+        input_ids = tokenized["input_ids"].astype(np.int64)
+        attention_mask = tokenized["attention_mask"].astype(np.int64)
+        padding = bucketed_length(input_ids.shape[1], PROMPT_LENGTH_BUCKETS) - input_ids.shape[1]
+        input_ids = np.pad(input_ids, ((0, 0), (0, padding)), constant_values=self.processor.tokenizer.pad_token_id)
+        attention_mask = np.pad(attention_mask, ((0, 0), (0, padding)), constant_values=0)
+        return input_ids, attention_mask
+
+    def _token_stress_pairs(self, token_ids, head_preds):
+        # the head predicts the stress of the next token, as in the PyTorch client
+        head_preds_right_shifted = np.concatenate([head_preds[:, -1:], head_preds[:, :-1]], axis=1)
+        return [
+            get_word_emphasis_pairs(token_ids[i].tolist(), head_preds_right_shifted[i], self.processor)
+            for i in range(len(token_ids))
+        ]
+
+    def _score_audio(self, audio_list):
+        encoder_hidden_states, cross_key_values = self._encode(audio_list)
+        sequences, decoder_hidden_states = self._generate(cross_key_values, max_new_tokens_for_audio(audio_list))
+        head_preds = self.head.run(None, {
+            "decoder_hidden_states": decoder_hidden_states,
+            "encoder_hidden_states": encoder_hidden_states,
+        })[0]
+        return self._token_stress_pairs(sequences, head_preds)
+
+    def _score_transcriptions(self, encoder_hidden_states, cross_key_values, transcriptions):
+        input_ids, attention_mask = self._tokenize(transcriptions)
+        feeds = {"input_ids": input_ids, "attention_mask": attention_mask, "encoder_hidden_states": encoder_hidden_states}
+        feeds.update(zip(self._cross_names, cross_key_values))
+        head_preds = self.scorer.run(None, {name: feeds[name] for name in self._scorer_inputs})[0]
+        return self._token_stress_pairs(input_ids, head_preds)
+
+    def predict(
+        self, audio: Dict[str, Union[np.ndarray, int]], transcription=None, return_pairs=True
+    ):
+        return self.predict_batch(
+            [audio], [transcription] if transcription else None, return_pairs=return_pairs
+        )[0]
+
+    def predict_prompts(
+        self,
+        audio: Dict[str, Union[np.ndarray, int]],
+        transcriptions: List[str],
+        return_pairs=True,
+    ):
+        # the clip is encoded once and its states repeated for every prompt
+        if not transcriptions:
+            return []
+        encoder_hidden_states, cross_key_values = self._encode([prepare_audio(audio)])
+        repeats = len(transcriptions)
+        token_stress_pairs_list = self._score_transcriptions(
+            np.repeat(encoder_hidden_states, repeats, axis=0),
+            [np.repeat(states, repeats, axis=0) for states in cross_key_values],
+            transcriptions,
+        )
+        return self._format([word_level_stress(pairs) for pairs in token_stress_pairs_list], return_pairs)
+
+    def predict_batch(
+        self,
+        audio_list: List[Dict[str, Union[np.ndarray, int]]],
+        transcription_list: Optional[List[str]] = None,
+        return_pairs=True,
+        audio_prepared=False,
+    ):
+        if audio_prepared:
+            audio_arrays = [audio_dict["array"] for audio_dict in audio_list]
+        else:
+            audio_arrays = [prepare_audio(audio_dict) for audio_dict in audio_list]
+        if transcription_list:
+            if len(transcription_list) != len(audio_list):
+                raise ValueError("Length of transcriptions list must match length of audio_dicts list.")
+            encoder_hidden_states, cross_key_values = self._encode(audio_arrays)
+            token_stress_pairs_list = self._score_transcriptions(
+                encoder_hidden_states, cross_key_values, transcription_list
+            )
+        else:
+            token_stress_pairs_list = self._score_audio(audio_arrays)
+        return self._format([word_level_stress(pairs) for pairs in token_stress_pairs_list], return_pairs)
+
+    @staticmethod
+    def _format(word_emphasis_pairs_list, return_pairs):
+        if return_pairs:
+            return word_emphasis_pairs_list
+        return [
+            (
+                " ".join([x[0] for x in word_emphasis_pairs]),
+                [1 if x[1] == 1 else 0 for x in word_emphasis_pairs],
+            )
+            for word_emphasis_pairs in word_emphasis_pairs_list
+        ]
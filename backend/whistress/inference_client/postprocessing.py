@@ -0,0 +1,121 @@
+import librosa
+import numpy as np
+
+# Helpers shared by the PyTorch and ONNX Runtime clients; this module must not import torch.
+
+# prompts are padded to the longest one in the batch, rounded up to one of these sizes
+PROMPT_MAX_LENGTH = 200
+PROMPT_LENGTH_BUCKETS = (16, 32, 64, 128, PROMPT_MAX_LENGTH)
+# without a prompt the decoding budget follows the longest clip in the batch.
+# Fast speech (4-5 words/s) with punctuation comes to about 1.75 GPT-2 BPE tokens
+# per word, i.e. up to ~9 tokens/s; the budget allows 10 so no transcript is cut
+GENERATION_MAX_LENGTH = 200
+GENERATION_TOKENS_PER_SECOND = 10
+GENERATION_TOKEN_MARGIN = 10
+
+
+def get_word_emphasis_pairs(
+    transcription_preds, emphasis_preds, processor, filter_special_tokens=True
+):
+    emphasis_preds_list = emphasis_preds.tolist()
+    transcription_preds_words = [
+        processor.tokenizer.decode([i], skip_special_tokens=False)
+        for i in transcription_preds
+    ]
+    if filter_special_tokens:
+        special_tokens_indices = [
+            i
+            for i, x in enumerate(transcription_preds)
+            if x in processor.tokenizer.all_special_ids
+        ]
+        emphasis_preds_list = [
+            x
+            for i, x in enumerate(emphasis_preds_list)
+            if i not in special_tokens_indices
+        ]
+        transcription_preds_words = [
+            x
+            for i, x in enumerate(transcription_preds_words)
+            if i not in special_tokens_indices
+        ]
+    return list(zip(transcription_preds_words, emphasis_preds_list))
+
+
+def max_new_tokens_for_audio(
+    audio_list,
+    sampling_rate=16000,
+    tokens_per_second=GENERATION_TOKENS_PER_SECOND,
+    margin=GENERATION_TOKEN_MARGIN,
+    max_length=GENERATION_MAX_LENGTH,
+):
+    """
+    Token budget for generate_dual: tokens_per_second * longest clip (in seconds)
+    plus a margin, never above the old fixed max_length.
+    """
+    longest_seconds = max(len(audio) for audio in audio_list) / sampling_rate
+    budget = int(np.ceil(longest_seconds * tokens_per_second)) + margin
+    # max_length counted the <|startoftranscript|><|notimestamps|> prompt as well
+    return min(budget, max_length - 2)
+
+
+def prepare_audio(audio, target_sr=16000):
+    sr = audio["sampling_rate"]
+    y = np.asarray(audio["array"], dtype=np.float32)
+    # resample to 16kHz (audio decoded by the worker already is)
+    if sr != target_sr:
+        y = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
+    # Normalize the audio (scale to [-1, 1])
+    peak = np.max(np.abs(y))
+    return y / peak if peak > 0 else y
+
+
+def bucketed_length(longest, length_buckets=PROMPT_LENGTH_BUCKETS):
+    """
+    Smallest bucket that fits ``longest`` tokens (``longest`` itself when none does).
+    """
+    return next((b for b in sorted(length_buckets) if b >= longest), longest)
+
+
+def merge_stressed_tokens(tokens_with_stress):
+    """
+    tokens_with_stress is a list of tuples: (token_string, stress_value)
+    e.g.:
+       [(" I", 0), (" didn", 1), ("'t", 0), (" say", 0), (" he", 0), (" stole", 0),
+        (" the", 0), (" money", 0), (".", 0)]
+    Returns a list of merged tuples, combining subwords into full words.
+    """
+    merged = []
+
+    current_word = ""
+    current_stress = 0  # 0 means not stressed, 1 means stressed
+
+    for token, stress in tokens_with_stress:
+        # If token starts with a space (or is the very first), we treat it as a new word
+        # or if current_word is empty (first iteration).
+        if token.startswith(" ") or current_word == "":
+            # If we already have something in current_word, push it into merged
+            # before starting a new one
+            if current_word:
+                merged.append((current_word, current_stress))
+
+            # Start a new word
+            current_word = token
+            current_stress = stress
+        else:
+            # Otherwise, it's a subword that should be appended to the previous word
+            current_word += token
+            # If any sub-token is stressed, the whole merged word is stressed
+            current_stress = max(current_stress, stress)
+
+    # Don't forget to append the final word
+    if current_word:
+        merged.append((current_word, current_stress))
+
+    return merged
+
+
+def word_level_stress(token_stress_pairs, strip_words=True):
+    word_level = merge_stressed_tokens(token_stress_pairs)
+    if strip_words:
+        word_level = [(word.strip(), stress) for word, stress in word_level]
+    return word_level
@@ -0,0 +1,169 @@
+import threading
+import torch
+import torch.nn.functional as F
+from ..model import WhiStress
+from .postprocessing import PROMPT_LENGTH_BUCKETS, bucketed_length
+
+# batch sizes the compiled graphs are built for (powers of two up to the default max batch)
+COMPILE_BATCH_BUCKETS = (1, 2, 4, 8, 16)
+
+
+def _bucket(size, buckets):
+    # smallest bucket that fits, None when none does (the call then runs eagerly)
+    fitted = bucketed_length(size, buckets)
+    return fitted if fitted in buckets else None
+
+
+def _pad_rows(tensor, batch_size):
+    # padded rows repeat the last real row, so they are ordinary inputs; their
+    # outputs are sliced off again
+    missing = batch_size - tensor.shape[0]
+    if missing:
+        tensor = torch.cat([tensor, tensor[-1:].expand(missing, *tensor.shape[1:])])
+    return tensor.contiguous()
+
+
+class StaticShapeRunner:
+    """
+    Optional torch.compile path for the Whisper encoder, the truncated
+    WhiStress.forward used to score prompts, and the stress head of generate_dual.
+    Inputs are padded to a fixed set of (batch, length) buckets and compiled with
+    static shapes, so every bucket is compiled once (compile_buckets, during
+    warm-up) and its graph reused afterwards. Inputs larger than the largest
+    bucket run eagerly.
+    """
+
+    def __init__(
+        self,
+        model: WhiStress,
+        batch_buckets=COMPILE_BATCH_BUCKETS,
+        length_buckets=PROMPT_LENGTH_BUCKETS,
+        backend="inductor",
+    ):
+        self.model = model
+        self.batch_buckets = tuple(sorted(set(batch_buckets)))
+        self.length_buckets = tuple(sorted(set(length_buckets)))
+        # each bucket is a separate graph; below this limit dynamo would quietly
+        # fall back to eager mode for the buckets compiled last
+        torch._dynamo.config.cache_size_limit = max(
+            torch._dynamo.config.cache_size_limit, len(self.batch_buckets) * len(self.length_buckets)
+        )
+        self._encode = torch.compile(model.encode_for_head, backend=backend, dynamic=False)
+        self._score = torch.compile(self._score_eager, backend=backend, dynamic=False)
+        self._head = torch.compile(model.head_logits, backend=backend, dynamic=False)
+        # right padding leaves the real positions of the head unchanged only if its
+        # self-attention is causal, which SDPA applies when no mask is given
+        self._pad_head_length = model.whisper_model.config._attn_implementation == "sdpa"
+        self._pad_token_id = model.processor.tokenizer.pad_token_id
+        self._lock = threading.Lock()
+        self._stats = {name: {"hits": 0, "misses": 0, "eager": 0} for name in ("encode", "score", "head")}
+        self._compiled = {name: set() for name in self._stats}
+
+    def _record(self, name, bucket):
+        with self._lock:
+            stats = self._stats[name]
+            if bucket is None:
+                stats["eager"] += 1
+            elif bucket in self._compiled[name]:
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+                self._compiled[name].add(bucket)
+
+    def bucket_stats(self):
+        """
+        Per compiled function: calls that reused a compiled bucket (hits), calls
+        that compiled a new one (misses), calls that fit no bucket (eager), and the
+        buckets compiled so far.
+        """
+        with self._lock:
+            return {
+                name: {**stats, "buckets": sorted(self._compiled[name])}
+                for name, stats in self._stats.items()
+            }
+
+    def _score_eager(
+        self, decoder_input_ids, decoder_attention_mask, encoder_last_hidden_state, layer_for_head_hidden_states
+    ):
+        return self.model(
+            decoder_input_ids=decoder_input_ids,
+            decoder_attention_mask=decoder_attention_mask,
+            truncate_backbone=True,
+            encoder_outputs=(encoder_last_hidden_state, layer_for_head_hidden_states),
+        ).logits
+
+    def encode_for_head(self, input_features):
+        batch_size = input_features.shape[0]
+        padded_batch_size = _bucket(batch_size, self.batch_buckets)
+        self._record("encode", None if padded_batch_size is None else (padded_batch_size,))
+        with torch.no_grad():
+            if padded_batch_size is None:
+                return self.model.encode_for_head(input_features)
+            states = self._encode(_pad_rows(input_features, padded_batch_size))
+        return tuple(hidden_states[:batch_size] for hidden_states in states)
+
+    def score(self, decoder_input_ids, decoder_attention_mask, input_features=None, encoder_outputs=None):
+        """
+        Stress logits of WhiStress.forward(truncate_backbone=True). As there,
+        encoder_outputs may hold one clip's states, broadcast over every prompt.
+        """
+        if encoder_outputs is None:
+            encoder_outputs = self.encode_for_head(input_features)
+        batch_size, length = decoder_input_ids.shape
+        encoder_outputs = [hidden_states.expand(batch_size, -1, -1) for hidden_states in encoder_outputs]
+        padded_batch_size = _bucket(batch_size, self.batch_buckets)
+        padded_length = _bucket(length, self.length_buckets)
+        if padded_batch_size is None or padded_length is None:
+            self._record("score", None)
+            with torch.no_grad():
+                return self._score_eager(decoder_input_ids, decoder_attention_mask, *encoder_outputs)
+        self._record("score", (padded_batch_size, padded_length))
+        decoder_input_ids = F.pad(decoder_input_ids, (0, padded_length - length), value=self._pad_token_id)
+        decoder_attention_mask = F.pad(decoder_attention_mask, (0, padded_length - length), value=0)
+        with torch.no_grad():
+            logits = self._score(
+                _pad_rows(decoder_input_ids, padded_batch_size),
+                _pad_rows(decoder_attention_mask, padded_batch_size),
+                *(_pad_rows(hidden_states, padded_batch_size) for hidden_states in encoder_outputs),
+            )
+        return logits[:batch_size, :length]
+
+    def head_logits(self, decoder_hidden_states, encoder_hidden_states):
+        """
+        Drop-in for WhiStress.head_logits (generate_dual's head_logits_fn).
+        """
+        batch_size, length, _ = decoder_hidden_states.shape
+        padded_batch_size = _bucket(batch_size, self.batch_buckets)
+        padded_length = _bucket(length, self.length_buckets) if self._pad_head_length else None
+        if padded_batch_size is None or padded_length is None:
+            self._record("head", None)
+            with torch.no_grad():
+                return self.model.head_logits(decoder_hidden_states, encoder_hidden_states)
+        self._record("head", (padded_batch_size, padded_length))
+        decoder_hidden_states = F.pad(decoder_hidden_states, (0, 0, 0, padded_length - length))
+        with torch.no_grad():
+            logits = self._head(
+                _pad_rows(decoder_hidden_states, padded_batch_size),
+                _pad_rows(encoder_hidden_states, padded_batch_size),
+            )
+        return logits[:batch_size, :length]
+
+    def compile_buckets(self):
+        """
+        Compile every bucket with dummy inputs, so no request waits for a compilation.
+        """
+        config = self.model.whisper_model.config
+        device = next(self.model.parameters()).device
+        for batch_size in self.batch_buckets:
+            input_features = torch.zeros(
+                batch_size, config.num_mel_bins, 2 * config.max_source_positions, device=device
+            )
+            encoder_outputs = self.encode_for_head(input_features)
+            for length in self.length_buckets:
+                decoder_input_ids = torch.full((batch_size, length), self._pad_token_id, device=device)
+                decoder_attention_mask = torch.ones(batch_size, length, dtype=torch.long, device=device)
+                self.score(decoder_input_ids, decoder_attention_mask, encoder_outputs=encoder_outputs)
+                if self._pad_head_length:
+                    self.head_logits(
+                        torch.zeros(batch_size, length, config.d_model, device=device), encoder_outputs[1]
+                    )
@@ -1,16 +1,51 @@
 import torch
+import contextlib
+import hashlib
+import threading
+from collections import OrderedDict
 from transformers import WhisperConfig
-import librosa
 import numpy as np
 import pathlib
 from torch.nn import functional as F
 from ..model import WhiStress
+from ..model.model import PACKED_WEIGHTS_FILENAME
 from typing import List, Union, Dict, Optional
+from .postprocessing import (
+    PROMPT_MAX_LENGTH,
+    PROMPT_LENGTH_BUCKETS,
+    bucketed_length,
+    get_word_emphasis_pairs,
+    max_new_tokens_for_audio,
+    merge_stressed_tokens,
+    prepare_audio,
+)
 
 PATH_TO_WEIGHTS = pathlib.Path(__file__).parent.parent / "weights"
+# encoder states kept for re-scoring a clip against new prompts (about 9 MB each for whisper-small)
+ENCODER_CACHE_MAX_ENTRIES = 16
 
 
 def get_loaded_model(device="cuda"):
+    """
+    Load from the packed, memory-mapped weights when pack_weights.py has produced
+    them, otherwise from the Hugging Face backbone plus the local .pt files.
+    """
+    packed_path = PATH_TO_WEIGHTS / PACKED_WEIGHTS_FILENAME
+    if packed_path.exists():
+        print('loading packed model from:', packed_path)
+        whistress_model = WhiStress.from_packed(packed_path, device="cpu")
+        whistress_model.processor.tokenizer.model_input_names = [
+            "input_ids",
+            "input_features", # 添加 input_features
+            "attention_mask",
+            "labels_head",
+        ]
+        whistress_model.to(device)
+        return whistress_model
+    return load_unpacked_model(device)
+
+
+def load_unpacked_model(device="cuda"):
     whisper_model_name = f"openai/whisper-small.en"
     whisper_config = WhisperConfig()
     whistress_model = WhiStress(
@@ -28,38 +63,101 @@ def get_loaded_model(device="cuda"):
     return whistress_model
 
 
-def get_word_emphasis_pairs(
-    transcription_preds, emphasis_preds, processor, filter_special_tokens=True
-):
-    emphasis_preds_list = emphasis_preds.tolist()
-    transcription_preds_words = [
-        processor.tokenizer.decode([i], skip_special_tokens=False)
-        for i in transcription_preds
-    ]
-    if filter_special_tokens:
-        special_tokens_indices = [
-            i
-            for i, x in enumerate(transcription_preds)
-            if x in processor.tokenizer.all_special_ids
-        ]
-        emphasis_preds_list = [
-            x
-            for i, x in enumerate(emphasis_preds_list)
-            if i not in special_tokens_indices
-        ]
-        transcription_preds_words = [
-            x
-            for i, x in enumerate(transcription_preds_words)
-            if i not in special_tokens_indices
-        ]
-    return list(zip(transcription_preds_words, emphasis_preds_list))
+def get_model_fingerprint(model, weights_dir=PATH_TO_WEIGHTS):
+    """
+    Identifies the loaded weights: a hash of the locally trained files (head and
+    metadata), the Whisper backbone name and layer_for_head. Used to key cached results.
+    Packed weights carry the fingerprint of the files they were converted from.
+    """
+    if model.model_fingerprint is not None:
+        return model.model_fingerprint
+    digest = hashlib.sha256()
+    digest.update(f"{model.whisper_backbone_name}|{model.layer_for_head}".encode())
+    for name in ("classifier.pt", "additional_decoder_block.pt", "metadata.json"):
+        with open(pathlib.Path(weights_dir) / name, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def variant_fingerprint(model_fingerprint, **options):
+    """
+    Fingerprint of the same weights run in a different execution mode (e.g. int8),
+    whose predictions may differ slightly and so must not share cached results.
+    """
+    enabled = {name: value for name, value in sorted(options.items()) if value}
+    if not enabled:
+        return model_fingerprint
+    digest = hashlib.sha256(model_fingerprint.encode())
+    for name, value in enabled.items():
+        digest.update(f"|{name}={value}".encode())
+    return digest.hexdigest()
+
+
+QUANTIZATION_MODES = ("int8",)
+
+
+def quantize_model(model: WhiStress, quantization="int8", quantize_head=False):
+    """
+    Dynamic int8 quantization (CPU only) of the Whisper backbone's linear layers and,
+    with quantize_head, of the additional decoder block and classifier. Weights are
+    stored as int8 and activations are quantized on the fly, so no calibration data
+    is needed. Modules are replaced in place.
+    """
+    if quantization not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATION_MODES}")
+    if next(model.parameters()).device.type != "cpu":
+        raise ValueError("Dynamic int8 quantization is only supported on CPU")
+    modules = [model.whisper_model]
+    if quantize_head:
+        modules += [model.additional_decoder_block, model.classifier]
+    for module in modules:
+        torch.ao.quantization.quantize_dynamic(
+            module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    return model
+
+
+PRECISIONS = ("fp32", "bf16")
+
+
+def reduce_precision(model: WhiStress, precision="bf16"):
+    """
+    Store the weights of every linear and convolution layer (backbone, additional
+    decoder block and classifier) in bfloat16, halving the memory traffic of the
+    matmuls. Run the model under precision_autocast: autocast would otherwise
+    re-cast the fp32 weights on every call. Layer norms and the positional
+    embeddings keep fp32 weights. The decoder's token embedding is tied to the
+    output projection (proj_out), so it is stored in bfloat16 as well; the
+    decoder builds its attention masks in the embedding dtype, and SDPA requires
+    them to match the bfloat16 queries under autocast.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+    if precision == "fp32":
+        return model
+    for module in model.modules():
+        if isinstance(module, (torch.nn.Linear, torch.nn.Conv1d)):
+            module.to(torch.bfloat16)
+    return model
 
 
-def inference_from_audio(audio: np.ndarray, model: WhiStress, device: str):
-    input_features = model.processor.feature_extractor(
-        audio, sampling_rate=16000, return_tensors="pt"
-    )["input_features"]
-    out_model = model.generate_dual(input_features=input_features.to(device))
+def precision_autocast(precision, device):
+    """
+    Context running the matmuls in bfloat16 for precision="bf16" (a no-op for fp32).
+    The stress head's logits are returned in fp32 either way (WhiStress.head_logits).
+    """
+    if precision in (None, "fp32"):
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+def inference_from_audio(audio: np.ndarray, model: WhiStress, device: str, static_shapes=None, front_end=None):
+    input_features = extract_input_features([audio], model, device, front_end)
+    out_model = model.generate_dual(
+        input_features=input_features,
+        max_new_tokens=max_new_tokens_for_audio([audio]),
+        head_logits_fn=static_shapes.head_logits if static_shapes is not None else None,
+    )
     emphasis_probs = F.softmax(out_model.logits, dim=-1)
     emphasis_preds = torch.argmax(emphasis_probs, dim=-1)
     emphasis_preds_right_shifted = torch.cat((emphasis_preds[:, -1:], emphasis_preds[:, :-1]), dim=1)
@@ -72,83 +170,132 @@ def inference_from_audio(audio: np.ndarray, model: WhiStress, device: str):
     return word_emphasis_pairs
 
 
-def prepare_audio(audio, target_sr=16000):
-    # resample to 16kHz
-    sr = audio["sampling_rate"]
-    y = audio["array"]
-    y = np.array(y, dtype=float)
-    y_resampled = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
-    # Normalize the audio (scale to [-1, 1])
-    y_resampled /= max(abs(y_resampled))
-    return y_resampled
+def tokenize_transcriptions(
+    transcriptions, processor, length_buckets=PROMPT_LENGTH_BUCKETS, max_length=PROMPT_MAX_LENGTH
+):
+    """
+    Tokenize prompts padded to the longest one in the batch (instead of always
+    max_length), rounded up to the smallest bucket that fits when length_buckets is set.
+    Returns input_ids and attention_mask tensors.
+    """
+    tokenized = processor.tokenizer(
+        transcriptions,
+        return_tensors="pt",
+        padding="longest",
+        truncation=True,
+        max_length=max_length,
+    )
+    input_ids = tokenized["input_ids"]
+    attention_mask = tokenized["attention_mask"]
+    if length_buckets:
+        longest = input_ids.shape[-1]
+        padded_length = bucketed_length(longest, length_buckets)
+        input_ids = F.pad(
+            input_ids, (0, padded_length - longest), value=processor.tokenizer.pad_token_id
+        )
+        attention_mask = F.pad(attention_mask, (0, padded_length - longest), value=0)
+    return input_ids, attention_mask
 
 
-def merge_stressed_tokens(tokens_with_stress):
+class EncoderStateCache:
     """
-    tokens_with_stress is a list of tuples: (token_string, stress_value)
-    e.g.:
-       [(" I", 0), (" didn", 1), ("'t", 0), (" say", 0), (" he", 0), (" stole", 0),
-        (" the", 0), (" money", 0), (".", 0)]
-    Returns a list of merged tuples, combining subwords into full words.
+    Bounded LRU of encoder states (final layer, layer_for_head) keyed by a hash of
+    the prepared 16kHz clip, so re-scoring a recording only runs the decoder.
     """
-    merged = []
 
-    current_word = ""
-    current_stress = 0  # 0 means not stressed, 1 means stressed
+    def __init__(self, max_entries=ENCODER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-    for token, stress in tokens_with_stress:
-        # If token starts with a space (or is the very first), we treat it as a new word
-        # or if current_word is empty (first iteration).
-        if token.startswith(" ") or current_word == "":
-            # If we already have something in current_word, push it into merged
-            # before starting a new one
-            if current_word:
-                merged.append((current_word, current_stress))
+    @staticmethod
+    def key_for(audio: np.ndarray):
+        return hashlib.sha256(np.ascontiguousarray(audio, dtype=np.float32).tobytes()).hexdigest()
 
-            # Start a new word
-            current_word = token
-            current_stress = stress
-        else:
-            # Otherwise, it's a subword that should be appended to the previous word
-            current_word += token
-            # If any sub-token is stressed, the whole merged word is stressed
-            current_stress = max(current_stress, stress)
+    def get(self, key):
+        with self._lock:
+            states = self._entries.get(key)
+            if states is not None:
+                self._entries.move_to_end(key)
+            return states
 
-    # Don't forget to append the final word
-    if current_word:
-        merged.append((current_word, current_stress))
+    def put(self, key, states):
+        with self._lock:
+            self._entries[key] = states
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
 
-    return merged
+    def __len__(self):
+        return len(self._entries)
 
 
-def inference_from_audio_and_transcription(
-    audio: np.ndarray, transcription, model: WhiStress, device: str
+def encode_audio(
+    audio: np.ndarray, model: WhiStress, device: str, encoder_cache=None, static_shapes=None, front_end=None
 ):
-    input_features = model.processor.feature_extractor(
-        audio, sampling_rate=16000, return_tensors="pt"
-    )["input_features"]
-    # convert transcription to input_ids
-    input_ids = model.processor.tokenizer(
-        transcription,
-        return_tensors="pt",
-        padding="max_length",
-        truncation=True,
-        max_length=200,
-    )["input_ids"]
-    out_model = model(
-                    input_features=input_features.to(device),
-                    decoder_input_ids=input_ids.to(device),
-                )
-    emphasis_probs = F.softmax(out_model.logits, dim=-1)
+    """
+    Encoder states of one prepared clip, taken from encoder_cache when possible
+    (and otherwise from the compiled encoder when static_shapes is given).
+    """
+    key = None
+    if encoder_cache is not None:
+        key = encoder_cache.key_for(audio)
+        states = encoder_cache.get(key)
+        if states is not None:
+            return states
+    input_features = extract_input_features([audio], model, device, front_end)
+    encode_for_head = model.encode_for_head if static_shapes is None else static_shapes.encode_for_head
+    with torch.no_grad():
+        states = tuple(
+            hidden_states.detach()
+            for hidden_states in encode_for_head(input_features)
+        )
+    if encoder_cache is not None:
+        encoder_cache.put(key, states)
+    return states
+
+
+def inference_from_encoder_states_and_transcriptions(
+    encoder_states, transcriptions, model: WhiStress, device: str, static_shapes=None
+):
+    """
+    Score one clip's encoder states against every transcription in a single
+    decoder batch (the encoder is not run again).
+    """
+    input_ids, attention_mask = tokenize_transcriptions(transcriptions, model.processor)
+    if static_shapes is not None:
+        logits = static_shapes.score(
+            input_ids.to(device), attention_mask.to(device), encoder_outputs=encoder_states
+        )
+    else:
+        logits = model(
+                        decoder_input_ids=input_ids.to(device),
+                        decoder_attention_mask=attention_mask.to(device),
+                        truncate_backbone=True,
+                        encoder_outputs=encoder_states,
+                    ).logits
+    emphasis_probs = F.softmax(logits, dim=-1)
     emphasis_preds = torch.argmax(emphasis_probs, dim=-1)
     emphasis_preds_right_shifted = torch.cat((emphasis_preds[:, -1:], emphasis_preds[:, :-1]), dim=1)
-    word_emphasis_pairs = get_word_emphasis_pairs(
-        input_ids[0],
-        emphasis_preds_right_shifted[0],
-        model.processor,
-        filter_special_tokens=True,
-    )
-    return word_emphasis_pairs
+    return [
+        get_word_emphasis_pairs(
+            input_ids[i],
+            emphasis_preds_right_shifted[i],
+            model.processor,
+            filter_special_tokens=True,
+        )
+        for i in range(len(transcriptions))
+    ]
+
+
+def inference_from_audio_and_transcription(
+    audio: np.ndarray, transcription, model: WhiStress, device: str, encoder_cache=None, static_shapes=None,
+    front_end=None,
+):
+    encoder_states = encode_audio(audio, model, device, encoder_cache, static_shapes, front_end)
+    return inference_from_encoder_states_and_transcriptions(
+        encoder_states, [transcription], model, device, static_shapes
+    )[0]
 
 def scored_transcription(audio, model, strip_words=True, transcription: str = None, device="cuda"):
     audio_arr = prepare_audio(audio)
@@ -164,42 +311,44 @@ def scored_transcription(audio, model, strip_words=True, transcription: str = No
     return word_level_stress
 
 ######################## 加上batch ########################
-def inference_from_audio_batch(audio_list: list[np.ndarray], model: WhiStress, device: str):
-    #接收一個音頻 NumPy 陣列的列表，執行批次模型推論。
-    # 1. 預處理所有音頻並收集 feature tensors
-    # WhisperProcessor.feature_extractor 可以直接處理音頻列表並自動填充
+def extract_input_features(audio_list: list[np.ndarray], model: WhiStress, device: str, front_end=None):
+    """
+    Log-mel input features of a batch on device: computed there in one pass by
+    front_end (a LogMelFrontEnd) when given, otherwise by the processor's
+    feature extractor and copied over.
+    """
+    if front_end is not None:
+        return front_end(audio_list)
     input_features_output = model.processor.feature_extractor(
         audio_list, sampling_rate=16000, return_tensors="pt"
     )
-    batch_input_features = input_features_output["input_features"].to(device)
+    return input_features_output["input_features"].to(device)
+
+
+def inference_from_audio_batch(
+    audio_list: list[np.ndarray], model: WhiStress, device: str, static_shapes=None, front_end=None
+):
+    #接收一個音頻 NumPy 陣列的列表，執行批次模型推論。
+    # 1. 預處理所有音頻並收集 feature tensors (front_end 不為 None 時整個批次直接在推論裝置上計算)
+    batch_input_features = extract_input_features(audio_list, model, device, front_end)
     
-    # 2. 執行模型推論
-    out_model = model.generate_dual(input_features=batch_input_features)
+    # 2. 執行模型推論 (解碼長度上限依批次中最長的音檔估算，全部輸出 EOS 即停止)
+    # static_shapes 不為 None 時 stress head 使用編譯過的 bucket graph
+    out_model = model.generate_dual(
+        input_features=batch_input_features,
+        max_new_tokens=max_new_tokens_for_audio(audio_list),
+        head_logits_fn=static_shapes.head_logits if static_shapes is not None else None,
+    )
 
     # 3. 後處理結果 (適應批次輸出)
     emphasis_probs_batch = F.softmax(out_model.logits, dim=-1) # (batch_size, seq_len, num_classes)
     emphasis_preds_batch = torch.argmax(emphasis_probs_batch, dim=-1) # (batch_size, seq_len)
     
-    # 處理 emphasis_preds_right_shifted_batch 的維度
-    # `emphasis_preds_batch` 的形狀是 `(batch_size, sequence_length)`
+    # `emphasis_preds_batch` 的形狀是 `(batch_size, sequence_length)`，
+    # [:, -1:] 為 (B, 1)、[:, :-1] 為 (B, S-1)，在 dim=1 串接後仍是 (B, S)
     emphasis_preds_right_shifted_batch = torch.cat(
-        (emphasis_preds_batch[:, -1:].unsqueeze(1), emphasis_preds_batch[:, :-1]), dim=1 # 修正 cat dim
+        (emphasis_preds_batch[:, -1:], emphasis_preds_batch[:, :-1]), dim=1
     )
-    # 再次確認：如果 emphasis_preds_batch 是 (B, S)，那麼 -1: 和 :-1 是在 S 維度
-    # cat 的結果還是 (B, S)
-    # emphasis_preds_right_shifted_batch = torch.cat(
-    #     (emphasis_preds_batch[:, -1:], emphasis_preds_batch[:, :-1]), dim=1
-    # )
-    # 這個應該是錯的，因為 `emphasis_preds[:, -1:]` 是一個 `(B, 1)` 的 tensor。
-    # `emphasis_preds[:, :-1]` 是一個 `(B, S-1)` 的 tensor。
-    # 它們在 dim=1 堆疊是正確的。
-
-    # 然而，原始代碼的 `torch.cat((emphasis_preds[:, -1:], emphasis_preds[:, :-1]), dim=1)`
-    # 實際上是對 `(Batch_size, Sequence_length)` 的 `emphasis_preds` 進行操作，
-    # 其中 `emphasis_preds[:, -1:]` 會得到 `(Batch_size, 1)`，
-    # `emphasis_preds[:, :-1]` 會得到 `(Batch_size, Sequence_length - 1)`。
-    # 這兩個在 `dim=1` 上 concatenate 會得到 `(Batch_size, Sequence_length)`。
-    # 所以原始代碼在新的批次場景下是正確的。
 
     all_word_emphasis_pairs = []
     # 遍歷批次中的每個結果
@@ -219,35 +368,40 @@ def inference_from_audio_batch(audio_list: list[np.ndarray], model: WhiStress, d
 
 # --- 新增的帶轉錄的批次推論函數 ---
 def inference_from_audio_and_transcription_batch(
-    audio_list: list[np.ndarray], transcription_list: list[str], model: WhiStress, device: str
+    audio_list: list[np.ndarray],
+    transcription_list: list[str],
+    model: WhiStress,
+    device: str,
+    static_shapes=None,
+    front_end=None,
 ):
     """
     接收音頻 NumPy 陣列列表和對應的轉錄文本列表，執行批次模型推論。
     """
     # 1. 預處理所有音頻特徵
-    input_features_output = model.processor.feature_extractor(
-        audio_list, sampling_rate=16000, return_tensors="pt"
-    )
-    batch_input_features = input_features_output["input_features"].to(device)
+    batch_input_features = extract_input_features(audio_list, model, device, front_end)
 
-    # 2. 預處理所有轉錄文本為 input_ids
-    input_ids_output = model.processor.tokenizer(
-        transcription_list,
-        return_tensors="pt",
-        padding="max_length", # 確保填充到相同長度
-        truncation=True,
-        max_length=200, # 使用模型定義的 max_length
+    # 2. 預處理所有轉錄文本為 input_ids (填充到批次中最長的 prompt，再取 bucket 大小)
+    batch_input_ids, batch_attention_mask = tokenize_transcriptions(
+        transcription_list, model.processor
     )
-    batch_input_ids = input_ids_output["input_ids"].to(device)
+    batch_input_ids = batch_input_ids.to(device)
 
-    # 3. 執行模型推論
-    out_model = model(
-        input_features=batch_input_features,
-        decoder_input_ids=batch_input_ids,
-    )
+    # 3. 執行模型推論 (static_shapes 不為 None 時補齊到 (batch, length) bucket 後使用編譯過的 graph)
+    if static_shapes is not None:
+        logits = static_shapes.score(
+            batch_input_ids, batch_attention_mask.to(device), input_features=batch_input_features
+        )
+    else:
+        logits = model(
+            input_features=batch_input_features,
+            decoder_input_ids=batch_input_ids,
+            decoder_attention_mask=batch_attention_mask.to(device),
+            truncate_backbone=True, # 只跑到 layer_for_head，不算 lm_head
+        ).logits
     
     # 4. 後處理結果
-    emphasis_probs_batch = F.softmax(out_model.logits, dim=-1)
+    emphasis_probs_batch = F.softmax(logits, dim=-1)
     emphasis_preds_batch = torch.argmax(emphasis_probs_batch, dim=-1)
 
     emphasis_preds_right_shifted_batch = torch.cat(
@@ -270,15 +424,20 @@ def inference_from_audio_and_transcription_batch(
     return all_word_emphasis_pairs
 
 # --- 最終的 `scored_transcription` 和 `scored_transcription_batch` 函數 ---
-def scored_transcription(audio_dict, model, strip_words=True, transcription: str = None, device="cuda"):
+def scored_transcription(
+    audio_dict, model, strip_words=True, transcription: str = None, device="cuda", encoder_cache=None, static_shapes=None,
+    front_end=None,
+):
     audio_arr = prepare_audio(audio_dict)
     token_stress_pairs = None
     if transcription:
-        # 單個音頻和轉錄的推論
-        token_stress_pairs = inference_from_audio_and_transcription(audio_arr, transcription, model, device)
+        # 單個音頻和轉錄的推論 (encoder_cache 中已有這段音訊時只跑 decoder)
+        token_stress_pairs = inference_from_audio_and_transcription(
+            audio_arr, transcription, model, device, encoder_cache, static_shapes, front_end
+        )
     else:
         # 單個音頻的推論
-        token_stress_pairs = inference_from_audio(audio_arr, model, device)
+        token_stress_pairs = inference_from_audio(audio_arr, model, device, static_shapes, front_end)
     
     word_level_stress = merge_stressed_tokens(token_stress_pairs)
     if strip_words:
@@ -290,20 +449,27 @@ def scored_transcription_batch(
     model: WhiStress,
     strip_words=True,
     transcriptions: Optional[List[str]] = None,
-    device="cuda"
+    device="cuda",
+    audio_prepared=False,
+    static_shapes=None,
+    front_end=None,
 ):
     #接收一個音頻字典列表，對所有音頻執行批次推論
-    prepared_audio_arrs = [prepare_audio(audio_dict) for audio_dict in audio_dicts]
+    # audio_prepared=True 時音訊已重新取樣並正規化，不再逐筆執行 prepare_audio
+    if audio_prepared:
+        prepared_audio_arrs = [audio_dict["array"] for audio_dict in audio_dicts]
+    else:
+        prepared_audio_arrs = [prepare_audio(audio_dict) for audio_dict in audio_dicts]
     
     if transcriptions:
         if len(transcriptions) != len(audio_dicts):
             raise ValueError("Length of transcriptions list must match length of audio_dicts list.")
         batch_token_stress_pairs_list = inference_from_audio_and_transcription_batch(
-            prepared_audio_arrs, transcriptions, model, device
+            prepared_audio_arrs, transcriptions, model, device, static_shapes, front_end
         )
     else:
         batch_token_stress_pairs_list = inference_from_audio_batch(
-            prepared_audio_arrs, model, device
+            prepared_audio_arrs, model, device, static_shapes, front_end
         )
 
     all_results = []
@@ -313,4 +479,30 @@ def scored_transcription_batch(
             word_level_stress = [(word.strip(), stress) for word, stress in word_level_stress]
         all_results.append(word_level_stress)
     
-    return all_results
\ No newline at end of file
+    return all_results
+
+def scored_prompts(
+    audio_dict: Dict[str, Union[np.ndarray, int]],
+    transcriptions: List[str],
+    model: WhiStress,
+    strip_words=True,
+    device="cuda",
+    encoder_cache=None,
+    static_shapes=None,
+    front_end=None,
+):
+    # 同一段錄音對多個候選轉錄評分：encoder 只跑一次 (encoder_cache 命中時不跑)，
+    # 所有 prompt 放在同一個 decoder 批次
+    audio_arr = prepare_audio(audio_dict)
+    encoder_states = encode_audio(audio_arr, model, device, encoder_cache, static_shapes, front_end)
+    batch_token_stress_pairs_list = inference_from_encoder_states_and_transcriptions(
+        encoder_states, transcriptions, model, device, static_shapes
+    )
+
+    all_results = []
+    for token_stress_pairs in batch_token_stress_pairs_list:
+        word_level_stress = merge_stressed_tokens(token_stress_pairs)
+        if strip_words:
+            word_level_stress = [(word.strip(), stress) for word, stress in word_level_stress]
+        all_results.append(word_level_stress)
+    return all_results
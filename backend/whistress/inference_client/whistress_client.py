@@ -1,24 +1,89 @@
 import numpy as np
-from .utils import get_loaded_model, scored_transcription, scored_transcription_batch
+from .utils import (
+    ENCODER_CACHE_MAX_ENTRIES,
+    EncoderStateCache,
+    get_loaded_model,
+    get_model_fingerprint,
+    precision_autocast,
+    quantize_model,
+    reduce_precision,
+    scored_prompts,
+    scored_transcription,
+    scored_transcription_batch,
+    variant_fingerprint,
+)
+from .static_shapes import COMPILE_BATCH_BUCKETS, StaticShapeRunner
+from .features import LogMelFrontEnd
 from typing import Union, Dict, Optional, List
 
 
 class WhiStressInferenceClient:
-    def __init__(self, device="cuda"):
+    def __init__(
+        self,
+        device="cuda",
+        encoder_cache_size=ENCODER_CACHE_MAX_ENTRIES,
+        quantization: Optional[str] = None,
+        quantize_head=False,
+        compile_backend: Optional[str] = None,
+        compile_batch_buckets=COMPILE_BATCH_BUCKETS,
+        precision: Optional[str] = None,
+    ):
+        # quantization="int8" applies dynamic int8 quantization to the backbone's
+        # linear layers (CPU only); quantize_head also covers the stress head.
+        # compile_backend (e.g. "inductor") runs the encoder, prompt scoring and the
+        # stress head through torch.compile with inputs padded to shape buckets.
+        # precision="bf16" runs the backbone and the stress head with bfloat16 matmuls
+        # (None or "fp32" keeps full precision)
+        if precision not in (None, "fp32") and quantization is not None:
+            raise ValueError("bf16 precision cannot be combined with int8 quantization")
         self.device = device
+        self.precision = precision or "fp32"
+        # encoder states of recent clips, reused when a clip is scored against new prompts
+        self.encoder_cache = EncoderStateCache(encoder_cache_size) if encoder_cache_size else None
         self.whistress = get_loaded_model(self.device)
+        # log-mel features of a whole batch computed on the device in one pass (predict_batch)
+        self.front_end = LogMelFrontEnd(self.whistress.processor.feature_extractor, self.device)
+        # identifies these weights, so cached results from other weights are never reused
+        self.model_fingerprint = get_model_fingerprint(self.whistress)
+        if quantization is not None:
+            quantize_model(self.whistress, quantization, quantize_head)
+            self.model_fingerprint = variant_fingerprint(
+                self.model_fingerprint, quantization=quantization, quantize_head=quantize_head
+            )
+        if self.precision != "fp32":
+            reduce_precision(self.whistress, self.precision)
+            self.model_fingerprint = variant_fingerprint(self.model_fingerprint, precision=self.precision)
+        # same weights and math as eager mode, so the fingerprint is kept;
+        # compile_buckets() runs at worker startup (inference_replicas.compile_static_shapes)
+        self.static_shapes = (
+            StaticShapeRunner(self.whistress, compile_batch_buckets, backend=compile_backend)
+            if compile_backend else None
+        )
+
+    def compile_buckets(self):
+        # compiled under the same autocast state as the requests, so the graphs are reused
+        with precision_autocast(self.precision, self.device):
+            self.static_shapes.compile_buckets()
+
+    def bucket_stats(self):
+        # hit/miss counts of the compiled shape buckets (None without compile_backend)
+        return self.static_shapes.bucket_stats() if self.static_shapes is not None else None
 
     def predict(
         self, audio: Dict[str, Union[np.ndarray, int]], transcription=None, return_pairs=True
     ):
         #原來只支援單一筆預測的程式
-        word_emphasis_pairs = scored_transcription(
-            audio=audio, 
-            model=self.whistress, 
-            device=self.device, 
-            strip_words=True, 
-            transcription=transcription
-        )
+        with precision_autocast(self.precision, self.device):
+            word_emphasis_pairs = scored_transcription(
+                audio=audio, 
+                model=self.whistress, 
+                device=self.device, 
+                strip_words=True, 
+                transcription=transcription,
+                encoder_cache=self.encoder_cache,
+                static_shapes=self.static_shapes,
+                front_end=self.front_end,
+            )
         if return_pairs:
             return word_emphasis_pairs
         # returs transcription str and list of emphasized words
@@ -30,21 +95,57 @@ class WhiStressInferenceClient:
             1 if x[1] == 1 else 0 for x in word_emphasis_pairs 
         ]
 
+    def predict_prompts(
+        self,
+        audio: Dict[str, Union[np.ndarray, int]],
+        transcriptions: List[str],
+        return_pairs=True,
+    ):
+        # 同一段錄音對多個候選轉錄評分：約一次 encoder 加上一次 N 個 prompt 的 decoder 批次
+        if not transcriptions:
+            return []
+        with precision_autocast(self.precision, self.device):
+            word_emphasis_pairs_list = scored_prompts(
+                audio_dict=audio,
+                transcriptions=transcriptions,
+                model=self.whistress,
+                device=self.device,
+                strip_words=True,
+                encoder_cache=self.encoder_cache,
+                static_shapes=self.static_shapes,
+                front_end=self.front_end,
+            )
+        if return_pairs:
+            return word_emphasis_pairs_list
+        return [
+            (
+                " ".join([x[0] for x in word_emphasis_pairs]),
+                [1 if x[1] == 1 else 0 for x in word_emphasis_pairs],
+            )
+            for word_emphasis_pairs in word_emphasis_pairs_list
+        ]
+
     def predict_batch(
         self, 
         audio_list: List[Dict[str, Union[np.ndarray, int]]], 
         transcription_list: Optional[List[str]] = None, 
-        return_pairs=True
+        return_pairs=True,
+        audio_prepared=False,
     ):
         # 對多個音頻和轉錄進行批次推論。
+        # audio_prepared=True 表示音訊已是 16kHz 並正規化 (例如由 Worker 的前處理 pool 完成)
         print("&&&inclient: predict_batch")
-        word_emphasis_pairs_list_of_lists = scored_transcription_batch(
-            audio_dicts=audio_list, 
-            model=self.whistress, 
-            device=self.device, 
-            strip_words=True, 
-            transcriptions=transcription_list
-        )
+        with precision_autocast(self.precision, self.device):
+            word_emphasis_pairs_list_of_lists = scored_transcription_batch(
+                audio_dicts=audio_list, 
+                model=self.whistress, 
+                device=self.device, 
+                strip_words=True, 
+                transcriptions=transcription_list,
+                audio_prepared=audio_prepared,
+                static_shapes=self.static_shapes,
+                front_end=self.front_end,
+            )
 
         if return_pairs:
             return word_emphasis_pairs_list_of_lists
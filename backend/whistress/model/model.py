@@ -6,6 +6,10 @@ from transformers import (
 )
 from transformers.models.whisper.modeling_whisper import WhisperDecoderLayer
 from transformers.modeling_outputs import BaseModelOutput
+from transformers.cache_utils import EncoderDecoderCache
+from transformers import GenerationConfig
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
 import torch.nn.functional as F
 import torch.nn as nn
 import torch
@@ -14,6 +18,11 @@ from dataclasses import dataclass
 from typing import Optional
 import json
 
+# single memory-mappable file holding the backbone, the head and metadata.json
+PACKED_WEIGHTS_FILENAME = "whistress.safetensors"
+# tied to decoder.embed_tokens.weight, so not stored twice
+TIED_WEIGHT_KEYS = ("whisper_model.proj_out.weight",)
+
 
 @dataclass
 class CustomModelOutput(BaseModelOutput):
@@ -58,12 +67,17 @@ class WhiStress(PreTrainedModel):
         config: WhisperConfig,
         layer_for_head: Optional[int] = None,
         whisper_backbone_name="openai/whisper-small.en",
+        whisper_config: Optional[WhisperConfig] = None,
     ):
         super().__init__(config)
         self.whisper_backbone_name = whisper_backbone_name
-        self.whisper_model = WhisperForConditionalGeneration.from_pretrained(
-            self.whisper_backbone_name,
-        ).eval()
+        if whisper_config is not None:
+            # weights are assigned afterwards (see from_packed)
+            self.whisper_model = WhisperForConditionalGeneration(whisper_config).eval()
+        else:
+            self.whisper_model = WhisperForConditionalGeneration.from_pretrained(
+                self.whisper_backbone_name,
+            ).eval()
         self.processor = WhisperProcessor.from_pretrained(self.whisper_backbone_name)
 
         input_dim = self.whisper_model.config.d_model  # Model's hidden size
@@ -79,6 +93,8 @@ class WhiStress(PreTrainedModel):
         class_weights = torch.tensor([neg_weight, pos_weight])
         self.loss_fct = nn.CrossEntropyLoss(ignore_index=-100, weight=class_weights)
         self.layer_for_head = -1 if layer_for_head is None else layer_for_head
+        # set by from_packed (computed when the weights were packed)
+        self.model_fingerprint = None
 
     def to(self, device: str = ("cuda" if torch.cuda.is_available() else "cpu")):
         self.whisper_model.to(device)
@@ -113,6 +129,62 @@ class WhiStress(PreTrainedModel):
                 self.layer_for_head = metadata["layer_for_head"]
 
 
+    def save_packed(self, path, model_fingerprint=None):
+        """
+        Write every weight (backbone, additional decoder block, classifier) and the
+        metadata into one safetensors file that from_packed can memory-map.
+        """
+        state_dict = {
+            key: tensor.detach().cpu().contiguous()
+            for key, tensor in self.state_dict().items()
+            if key not in TIED_WEIGHT_KEYS
+        }
+        metadata = {
+            "layer_for_head": str(self.layer_for_head),
+            "whisper_backbone_name": self.whisper_backbone_name,
+            "whisper_config": self.whisper_model.config.to_json_string(),
+            "generation_config": self.whisper_model.generation_config.to_json_string(),
+        }
+        if model_fingerprint is not None:
+            metadata["model_fingerprint"] = model_fingerprint
+        save_file(state_dict, path, metadata=metadata)
+
+    @classmethod
+    def from_packed(cls, path, device="cpu"):
+        """
+        Build the model from a save_packed file without from_pretrained. On CPU the
+        parameters are views of the memory-mapped file, so worker processes on one
+        host share the same physical pages.
+        """
+        path = str(path)
+        with safe_open(path, framework="pt") as f:
+            metadata = f.metadata()
+        whisper_config = WhisperConfig.from_dict(json.loads(metadata["whisper_config"]))
+        # build the modules without allocating or initializing weights
+        with torch.device("meta"):
+            model = cls(
+                whisper_config,
+                layer_for_head=int(metadata["layer_for_head"]),
+                whisper_backbone_name=metadata["whisper_backbone_name"],
+                whisper_config=whisper_config,
+            )
+        state_dict = load_file(path, device=str(device))
+        missing, unexpected = model.load_state_dict(state_dict, strict=False, assign=True)
+        missing = [key for key in missing if key not in TIED_WEIGHT_KEYS]
+        if missing or unexpected:
+            raise ValueError(
+                f"Packed weights do not match the model: missing {missing}, unexpected {unexpected}"
+            )
+        model.whisper_model.tie_weights()
+        model.whisper_model.generation_config = GenerationConfig.from_dict(
+            json.loads(metadata["generation_config"])
+        )
+        model.model_fingerprint = metadata.get("model_fingerprint")
+        for param in model.parameters():
+            param.requires_grad = False
+        model.eval()
+        return model
+
     def train(self, mode: Optional[bool] = True):
         # freeze whisper and train classifier
         self.whisper_model.eval()
@@ -131,42 +203,136 @@ class WhiStress(PreTrainedModel):
         self.additional_decoder_block.eval()
         self.classifier.eval()
 
+    def encode_for_head(self, input_features):
+        """
+        Run the Whisper encoder and keep only what the stress head needs: the final
+        output (for cross-attention) and the hidden state at ``layer_for_head``.
+        Returns (last_hidden_state, layer_for_head_hidden_states).
+        """
+        encoder = self.whisper_model.get_encoder()
+        # hidden_states tuples hold the embeddings plus one entry per layer
+        head_index = self.layer_for_head % (len(encoder.layers) + 1)
+
+        hidden_states = F.gelu(encoder.conv1(input_features))
+        hidden_states = F.gelu(encoder.conv2(hidden_states))
+        hidden_states = hidden_states.permute(0, 2, 1) + encoder.embed_positions.weight
+
+        layer_for_head_hidden_states = None
+        for idx, encoder_layer in enumerate(encoder.layers):
+            if idx == head_index:
+                layer_for_head_hidden_states = hidden_states
+            hidden_states = encoder_layer(hidden_states, None, layer_head_mask=None)[0]
+        hidden_states = encoder.layer_norm(hidden_states)
+        if layer_for_head_hidden_states is None:
+            layer_for_head_hidden_states = hidden_states
+        return hidden_states, layer_for_head_hidden_states
+
+    def decode_to_head(
+        self, decoder_input_ids, encoder_hidden_states, decoder_attention_mask=None
+    ):
+        """
+        Run the Whisper decoder only up to ``layer_for_head`` (no lm_head) and return
+        the hidden states the additional decoder block consumes.
+        """
+        decoder = self.whisper_model.get_decoder()
+        head_index = self.layer_for_head % (len(decoder.layers) + 1)
+
+        inputs_embeds = decoder.embed_tokens(decoder_input_ids)
+        cache_position = torch.arange(
+            decoder_input_ids.shape[1], device=inputs_embeds.device
+        )
+        positions = decoder.embed_positions(
+            decoder_input_ids, position_ids=cache_position.unsqueeze(0)
+        )
+        hidden_states = inputs_embeds + positions.to(inputs_embeds.device)
+        causal_mask = decoder._update_causal_mask(
+            decoder_attention_mask, inputs_embeds, cache_position, None, False
+        )
+
+        for decoder_layer in decoder.layers[:head_index]:
+            hidden_states = decoder_layer(
+                hidden_states,
+                attention_mask=causal_mask,
+                encoder_hidden_states=encoder_hidden_states,
+                use_cache=False,
+                cache_position=cache_position,
+            )[0]
+        if head_index == len(decoder.layers):
+            hidden_states = decoder.layer_norm(hidden_states)
+        return hidden_states
+
+    def head_logits(self, decoder_hidden_states, encoder_hidden_states):
+        """
+        Stress logits of the additional decoder block and classifier, for decoder
+        states at ``layer_for_head`` attending to encoder states at ``layer_for_head``.
+        The logits are always fp32, so the softmax and argmax over them stay exact
+        when the model runs under bf16 autocast.
+        """
+        additional_decoder_block_outputs = self.additional_decoder_block(
+            hidden_states=decoder_hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+        )
+        return self.classifier(additional_decoder_block_outputs[0]).float()
+
     def forward(
         self,
-        input_features,
+        input_features=None,
         attention_mask=None,
         decoder_input_ids=None,
         labels_head=None,
         whisper_labels=None,
+        truncate_backbone=False,
+        decoder_attention_mask=None,
+        encoder_outputs=None,
     ):
+        """
+        With ``truncate_backbone=True`` the decoder stops at ``layer_for_head`` and the
+        vocabulary logits are skipped (``whisper_logits`` is None); use it for scoring.
+        ``encoder_outputs`` may then hold precomputed ``encode_for_head`` results; a
+        single clip's states are broadcast over every prompt in ``decoder_input_ids``.
+        """
         device = "cuda" if torch.cuda.is_available() else "cpu"
         self.whisper_model.eval()
 
-        # pass the inputs through the model
-        backbone_outputs = self.whisper_model(
-            input_features=input_features,
-            attention_mask=attention_mask,
-            decoder_input_ids=decoder_input_ids,
-            output_hidden_states=True,
-            labels=whisper_labels,
-        )
-
-        # Extract the hidden states of the last layer of the decoder
-        decoder_last_layer_hidden_states = backbone_outputs.decoder_hidden_states[
-            self.layer_for_head
-        ].to(device)
+        if truncate_backbone:
+            if encoder_outputs is None:
+                encoder_outputs = self.encode_for_head(input_features)
+            encoder_last_hidden_state, layer_for_head_hidden_states = encoder_outputs
+            batch_size = decoder_input_ids.shape[0]
+            if encoder_last_hidden_state.shape[0] != batch_size:
+                encoder_last_hidden_state = encoder_last_hidden_state.expand(batch_size, -1, -1)
+                layer_for_head_hidden_states = layer_for_head_hidden_states.expand(batch_size, -1, -1)
+            decoder_last_layer_hidden_states = self.decode_to_head(
+                decoder_input_ids, encoder_last_hidden_state, decoder_attention_mask
+            )
+            whisper_logits = None
+        else:
+            # pass the inputs through the model
+            backbone_outputs = self.whisper_model(
+                input_features=input_features,
+                attention_mask=attention_mask,
+                decoder_input_ids=decoder_input_ids,
+                decoder_attention_mask=decoder_attention_mask,
+                output_hidden_states=True,
+                labels=whisper_labels,
+            )
 
-        # Extract the hidden states of the layer of the encoder who encapsulates best the prosodic features
-        layer_for_head_hidden_states = backbone_outputs.encoder_hidden_states[
-            self.layer_for_head
-        ].to(device)
+            # Extract the hidden states of the last layer of the decoder
+            decoder_last_layer_hidden_states = backbone_outputs.decoder_hidden_states[
+                self.layer_for_head
+            ]
+
+            # Extract the hidden states of the layer of the encoder who encapsulates best the prosodic features
+            layer_for_head_hidden_states = backbone_outputs.encoder_hidden_states[
+                self.layer_for_head
+            ]
+            whisper_logits = backbone_outputs.logits
+        decoder_last_layer_hidden_states = decoder_last_layer_hidden_states.to(device)
+        layer_for_head_hidden_states = layer_for_head_hidden_states.to(device)
         # Pass the decoder last hidden layers through the new head (decoder_block + lin cls)
-
-        additional_decoder_block_outputs = self.additional_decoder_block(
-            hidden_states=decoder_last_layer_hidden_states,
-            encoder_hidden_states=layer_for_head_hidden_states,
+        head_logits = self.head_logits(
+            decoder_last_layer_hidden_states, layer_for_head_hidden_states
         )
-        head_logits = self.classifier(additional_decoder_block_outputs[0].to(device))
 
         # calculate softmax
         head_probs = F.softmax(head_logits, dim=-1)
@@ -189,7 +355,7 @@ class WhiStress(PreTrainedModel):
         return CustomModelOutput(
             logits=head_logits,
             labels_head=labels_head,
-            whisper_logits=backbone_outputs.logits,
+            whisper_logits=whisper_logits,
             loss=loss,
             preds=preds,
         )
@@ -257,46 +423,73 @@ class WhiStress(PreTrainedModel):
         max_length=200,
         labels_head=None,
         whisper_labels=None,
+        single_pass=True,
+        max_new_tokens=None,
+        head_logits_fn=None,
         **generate_kwargs,
     ):
         """
         Generate both the Whisper output and custom head output sequences in alignment.
+
+        ``max_new_tokens`` (when given) replaces ``max_length`` as the decoding budget;
+        decoding stops earlier once every sequence in the batch has emitted EOS.
+
+        With ``single_pass=True`` the encoder runs once and the decoder hidden states
+        at ``layer_for_head`` are collected while decoding, so the backbone is not
+        run a second time on the generated sequences. ``single_pass=False`` keeps
+        the original generate + full forward pass.
+
+        ``head_logits_fn`` replaces ``head_logits`` for the stress head (e.g. a
+        compiled, shape-bucketed version); it gets the same two arguments.
         """
         device = "cuda" if torch.cuda.is_available() else "cpu"
-        # Generate the Whisper output sequence
-        whisper_outputs = self.whisper_model.generate(
-            input_features=input_features,
-            attention_mask=attention_mask,
-            max_length=max_length,
-            labels=whisper_labels,
-            return_dict_in_generate=True,
-            **generate_kwargs,
-        )
+        if max_new_tokens is not None:
+            generate_kwargs["max_new_tokens"] = max_new_tokens
+        else:
+            generate_kwargs["max_length"] = max_length
+        if single_pass:
+            (
+                whisper_outputs,
+                decoder_last_layer_hidden_states,
+                layer_for_head_hidden_states,
+            ) = self._generate_single_pass(
+                input_features,
+                attention_mask=attention_mask,
+                whisper_labels=whisper_labels,
+                **generate_kwargs,
+            )
+        else:
+            # Generate the Whisper output sequence
+            whisper_outputs = self.whisper_model.generate(
+                input_features=input_features,
+                attention_mask=attention_mask,
+                labels=whisper_labels,
+                return_dict_in_generate=True,
+                **generate_kwargs,
+            )
 
-        # pass the inputs through the model
-        backbone_outputs = self.whisper_model(
-            input_features=input_features,
-            attention_mask=attention_mask,
-            decoder_input_ids=whisper_outputs.sequences,
-            output_hidden_states=True,
-        )
+            # pass the inputs through the model
+            backbone_outputs = self.whisper_model(
+                input_features=input_features,
+                attention_mask=attention_mask,
+                decoder_input_ids=whisper_outputs.sequences,
+                output_hidden_states=True,
+            )
 
-        # Extract the hidden states of the last layer of the decoder
-        decoder_last_layer_hidden_states = backbone_outputs.decoder_hidden_states[
-            self.layer_for_head
-        ].to(device)
+            # Extract the hidden states of the last layer of the decoder
+            decoder_last_layer_hidden_states = backbone_outputs.decoder_hidden_states[
+                self.layer_for_head
+            ]
 
-        # Extract the hidden states of the last layer of the encoder
-        layer_for_head_hidden_states = backbone_outputs.encoder_hidden_states[
-            self.layer_for_head
-        ].to(device)
+            # Extract the hidden states of the last layer of the encoder
+            layer_for_head_hidden_states = backbone_outputs.encoder_hidden_states[
+                self.layer_for_head
+            ]
         # Pass the decoder last hidden layers through the new head (decoder_block + lin cls)
-
-        additional_decoder_block_outputs = self.additional_decoder_block(
-            hidden_states=decoder_last_layer_hidden_states,
-            encoder_hidden_states=layer_for_head_hidden_states,
+        head_logits = (head_logits_fn or self.head_logits)(
+            decoder_last_layer_hidden_states.to(device),
+            layer_for_head_hidden_states.to(device),
         )
-        head_logits = self.classifier(additional_decoder_block_outputs[0].to(device))
         head_probs = F.softmax(head_logits, dim=-1)
         preds = head_probs.argmax(dim=-1).to(device)
         preds = torch.where(
@@ -313,5 +506,71 @@ class WhiStress(PreTrainedModel):
             preds=whisper_outputs.sequences
         )
 
+    def _generate_single_pass(
+        self,
+        input_features,
+        attention_mask=None,
+        whisper_labels=None,
+        **generate_kwargs,
+    ):
+        """
+        Greedy decoding that keeps the encoder outputs and the decoder hidden states
+        at ``layer_for_head``. Returns (generate outputs, decoder states, encoder states).
+        """
+        # run the encoder once, keeping the final output and the layer for the head
+        encoder_last_hidden_state, layer_for_head_hidden_states = self.encode_for_head(
+            input_features
+        )
+        whisper_outputs = self.whisper_model.generate(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_last_hidden_state),
+            attention_mask=attention_mask,
+            labels=whisper_labels,
+            return_dict_in_generate=True,
+            output_hidden_states=True,
+            **generate_kwargs,
+        )
+        sequences = whisper_outputs.sequences
+
+        # step 0 holds the decoder prompt, every later step one fed-back token
+        decoder_hidden_states = torch.cat(
+            [step[self.layer_for_head] for step in whisper_outputs.decoder_hidden_states],
+            dim=1,
+        )
+        num_fed_tokens = decoder_hidden_states.shape[1]
+        past_key_values = whisper_outputs.get("past_key_values")
+        if num_fed_tokens >= sequences.shape[1]:
+            decoder_hidden_states = decoder_hidden_states[:, : sequences.shape[1]]
+        elif num_fed_tokens == sequences.shape[1] - 1 and past_key_values is not None:
+            # the last generated token (EOS or the max_length cut) is never fed back;
+            # one cached decoder step over it completes the sequence
+            if isinstance(past_key_values, tuple):
+                past_key_values = EncoderDecoderCache.from_legacy_cache(past_key_values)
+            last_step_outputs = self.whisper_model.get_decoder()(
+                input_ids=sequences[:, -1:],
+                encoder_hidden_states=encoder_last_hidden_state,
+                past_key_values=past_key_values,
+                output_hidden_states=True,
+                return_dict=True,
+            )
+            decoder_hidden_states = torch.cat(
+                [
+                    decoder_hidden_states,
+                    last_step_outputs.hidden_states[self.layer_for_head],
+                ],
+                dim=1,
+            )
+        else:
+            # the decoding steps do not line up with the returned sequences; run only
+            # the decoder over them, reusing the encoder output
+            decoder_hidden_states = self.decode_to_head(
+                sequences, encoder_last_hidden_state
+            )
+
+        return (
+            whisper_outputs,
+            decoder_hidden_states,
+            layer_for_head_hidden_states,
+        )
+
     def __str__(self):
         return "WhiStress"
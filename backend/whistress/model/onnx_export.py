@@ -0,0 +1,296 @@
+import json
+import os
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from .model import WhiStress
+from ..inference_client.onnx_client import (
+    ONNX_CONFIG_FILENAME,
+    ONNX_DECODER_FILENAME,
+    ONNX_ENCODER_FILENAME,
+    ONNX_HEAD_FILENAME,
+    ONNX_SCORER_FILENAME,
+)
+
+
+def _split_heads(attn, states):
+    batch_size, length, _ = states.shape
+    return states.view(batch_size, length, attn.num_heads, attn.head_dim).transpose(1, 2)
+
+
+def _attend(attn, hidden_states, key_states, value_states, mask=None):
+    # same math as WhisperAttention, written out so the key/value states can be
+    # graph inputs and outputs
+    batch_size, length, embed_dim = hidden_states.shape
+    query_states = _split_heads(attn, attn.q_proj(hidden_states) * attn.scaling)
+    weights = torch.matmul(query_states, key_states.transpose(-1, -2))
+    if mask is not None:
+        weights = weights + mask
+    probs = F.softmax(weights, dim=-1)
+    output = torch.matmul(probs, value_states).transpose(1, 2).reshape(batch_size, length, embed_dim)
+    return attn.out_proj(output)
+
+
+def _causal_mask(attention_mask, past_length, total_length, dtype):
+    # causal mask over past + new tokens, with padded keys masked out
+    key_positions = torch.arange(total_length, device=attention_mask.device)
+    query_positions = torch.arange(past_length, total_length, device=attention_mask.device)
+    allowed = (key_positions[None, :] <= query_positions[:, None])[None, None] & attention_mask[:, None, None, :].bool()
+    mask = torch.zeros(allowed.shape, dtype=dtype, device=attention_mask.device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)
+
+
+def _decoder_layer(layer, hidden_states, mask, cross_key, cross_value, past_key=None, past_value=None):
+    # one WhisperDecoderLayer; returns the new hidden states and the self-attention key/value states
+    residual = hidden_states
+    hidden_states = layer.self_attn_layer_norm(hidden_states)
+    key_states = _split_heads(layer.self_attn, layer.self_attn.k_proj(hidden_states))
+    value_states = _split_heads(layer.self_attn, layer.self_attn.v_proj(hidden_states))
+    if past_key is not None:
+        key_states = torch.cat([past_key, key_states], dim=2)
+        value_states = torch.cat([past_value, value_states], dim=2)
+    hidden_states = residual + _attend(layer.self_attn, hidden_states, key_states, value_states, mask)
+
+    residual = hidden_states
+    hidden_states = layer.encoder_attn_layer_norm(hidden_states)
+    hidden_states = residual + _attend(layer.encoder_attn, hidden_states, cross_key, cross_value)
+
+    residual = hidden_states
+    hidden_states = layer.final_layer_norm(hidden_states)
+    hidden_states = residual + layer.fc2(layer.activation_fn(layer.fc1(hidden_states)))
+    return hidden_states, key_states, value_states
+
+
+class EncoderForOnnx(nn.Module):
+    """
+    input_features -> (encoder states at layer_for_head, cross-attention key/value
+    states of every decoder layer). The cross-attention states are computed once
+    per clip instead of at every decoding step.
+    """
+
+    def __init__(self, model: WhiStress):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_features):
+        last_hidden_state, layer_for_head_hidden_states = self.model.encode_for_head(input_features)
+        cross_key_values = []
+        for layer in self.model.whisper_model.get_decoder().layers:
+            attn = layer.encoder_attn
+            cross_key_values.append(_split_heads(attn, attn.k_proj(last_hidden_state)))
+            cross_key_values.append(_split_heads(attn, attn.v_proj(last_hidden_state)))
+        return (layer_for_head_hidden_states, *cross_key_values)
+
+
+class DecoderForOnnx(nn.Module):
+    """
+    One decoder call over input_ids given the self-attention cache of the earlier
+    tokens (length 0 for the first call). Returns the vocabulary logits of the
+    last position, the hidden states at layer_for_head of the new tokens and the
+    updated cache. attention_mask covers past and new tokens (0 marks padding).
+    """
+
+    def __init__(self, model: WhiStress):
+        super().__init__()
+        self.decoder = model.whisper_model.get_decoder()
+        self.proj_out = model.whisper_model.proj_out
+        self.head_index = model.layer_for_head % (len(self.decoder.layers) + 1)
+
+    def forward(self, input_ids, attention_mask, *key_values):
+        num_layers = len(self.decoder.layers)
+        cross_key_values = key_values[: 2 * num_layers]
+        past_key_values = key_values[2 * num_layers:]
+        past_length = past_key_values[0].shape[2]
+        total_length = past_length + input_ids.shape[1]
+
+        if self.proj_out.weight is self.decoder.embed_tokens.weight:
+            # tied weights: the exporter folds the transpose the logits need into a
+            # second copy of the embedding; looking the tokens up in that transposed
+            # copy as well keeps a single (d_model, vocab) initializer
+            embed_weight_t = self.proj_out.weight.t()
+            inputs_embeds = embed_weight_t.index_select(1, input_ids.reshape(-1)).t()
+            inputs_embeds = inputs_embeds.reshape(input_ids.shape[0], input_ids.shape[1], -1)
+        else:
+            inputs_embeds = self.decoder.embed_tokens(input_ids)
+        hidden_states = inputs_embeds + self.decoder.embed_positions.weight[past_length:total_length]
+
+        mask = _causal_mask(attention_mask, past_length, total_length, hidden_states.dtype)
+
+        head_hidden_states = None
+        present_key_values = []
+        for idx, layer in enumerate(self.decoder.layers):
+            if idx == self.head_index:
+                head_hidden_states = hidden_states
+            hidden_states, key_states, value_states = _decoder_layer(
+                layer, hidden_states, mask, cross_key_values[2 * idx], cross_key_values[2 * idx + 1],
+                past_key_values[2 * idx], past_key_values[2 * idx + 1],
+            )
+            present_key_values += [key_states, value_states]
+        hidden_states = self.decoder.layer_norm(hidden_states)
+        if head_hidden_states is None:
+            head_hidden_states = hidden_states
+        if self.proj_out.weight is self.decoder.embed_tokens.weight:
+            logits = torch.matmul(hidden_states[:, -1], embed_weight_t)
+        else:
+            logits = self.proj_out(hidden_states[:, -1])
+        return (logits, head_hidden_states, *present_key_values)
+
+
+class HeadForOnnx(nn.Module):
+    """
+    (decoder states at layer_for_head, encoder states at layer_for_head) -> stress
+    prediction per token, as in WhiStress.forward.
+    """
+
+    def __init__(self, model: WhiStress):
+        super().__init__()
+        self.additional_decoder_block = model.additional_decoder_block
+        self.classifier = model.classifier
+
+    def forward(self, decoder_hidden_states, encoder_hidden_states):
+        outputs = self.additional_decoder_block(
+            hidden_states=decoder_hidden_states,
+            encoder_hidden_states=encoder_hidden_states,
+        )
+        return self.classifier(outputs[0]).argmax(dim=-1)
+
+
+class ScorerForOnnx(nn.Module):
+    """
+    Prompt scoring, as WhiStress.forward(truncate_backbone=True): the decoder runs
+    only up to layer_for_head (no vocabulary projection), followed by the stress
+    head. Takes the cross-attention states of those layers only.
+    """
+
+    def __init__(self, model: WhiStress):
+        super().__init__()
+        self.decoder = model.whisper_model.get_decoder()
+        self.head_index = model.layer_for_head % (len(self.decoder.layers) + 1)
+        self.head = HeadForOnnx(model)
+
+    def forward(self, input_ids, attention_mask, encoder_hidden_states, *cross_key_values):
+        length = input_ids.shape[1]
+        hidden_states = self.decoder.embed_tokens(input_ids) + self.decoder.embed_positions.weight[:length]
+        mask = _causal_mask(attention_mask, 0, length, hidden_states.dtype)
+        for idx, layer in enumerate(self.decoder.layers[: self.head_index]):
+            hidden_states, _, _ = _decoder_layer(
+                layer, hidden_states, mask, cross_key_values[2 * idx], cross_key_values[2 * idx + 1]
+            )
+        if self.head_index == len(self.decoder.layers):
+            hidden_states = self.decoder.layer_norm(hidden_states)
+        return self.head(hidden_states, encoder_hidden_states)
+
+
+def export_onnx(model: WhiStress, output_dir, model_fingerprint=None, opset_version=17):
+    """
+    Export the encoder, the decoder step (with KV cache), the stress head and the
+    prompt scorer (decoder truncated at layer_for_head plus the head) as ONNX graphs, plus the processor files and the generation settings the greedy
+    decoding loop needs, so WhiStressOnnxClient runs without the PyTorch model.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    model.eval()
+    whisper_config = model.whisper_model.config
+    decoder = model.whisper_model.get_decoder()
+    num_layers = len(decoder.layers)
+    num_heads = decoder.layers[0].self_attn.num_heads
+    head_dim = decoder.layers[0].self_attn.head_dim
+    d_model = whisper_config.d_model
+    encoder_length = whisper_config.max_source_positions
+    cross_names = [f"cross_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+    past_names = [f"past_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+    present_names = [f"present_{kind}_{i}" for i in range(num_layers) for kind in ("key", "value")]
+
+    batch_size = 2
+    input_features = torch.zeros(batch_size, whisper_config.num_mel_bins, 2 * encoder_length)
+    with torch.no_grad():
+        torch.onnx.export(
+            EncoderForOnnx(model),
+            (input_features,),
+            os.path.join(output_dir, ONNX_ENCODER_FILENAME),
+            input_names=["input_features"],
+            output_names=["encoder_hidden_states", *cross_names],
+            dynamic_axes={name: {0: "batch"} for name in ["input_features", "encoder_hidden_states", *cross_names]},
+            opset_version=opset_version,
+        )
+
+        cross_key_values = [torch.zeros(batch_size, num_heads, encoder_length, head_dim) for _ in cross_names]
+        past_key_values = [torch.zeros(batch_size, num_heads, 3, head_dim) for _ in past_names]
+        input_ids = torch.zeros(batch_size, 2, dtype=torch.long)
+        attention_mask = torch.ones(batch_size, 5, dtype=torch.long)
+        dynamic_axes = {
+            "input_ids": {0: "batch", 1: "length"},
+            "attention_mask": {0: "batch", 1: "total_length"},
+            "logits": {0: "batch"},
+            "decoder_hidden_states": {0: "batch", 1: "length"},
+        }
+        dynamic_axes.update({name: {0: "batch"} for name in cross_names})
+        dynamic_axes.update({name: {0: "batch", 2: "past_length"} for name in past_names})
+        dynamic_axes.update({name: {0: "batch", 2: "total_length"} for name in present_names})
+        torch.onnx.export(
+            DecoderForOnnx(model),
+            (input_ids, attention_mask, *cross_key_values, *past_key_values),
+            os.path.join(output_dir, ONNX_DECODER_FILENAME),
+            input_names=["input_ids", "attention_mask", *cross_names, *past_names],
+            output_names=["logits", "decoder_hidden_states", *present_names],
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+        )
+
+        torch.onnx.export(
+            HeadForOnnx(model),
+            (torch.zeros(batch_size, 5, d_model), torch.zeros(batch_size, encoder_length, d_model)),
+            os.path.join(output_dir, ONNX_HEAD_FILENAME),
+            input_names=["decoder_hidden_states", "encoder_hidden_states"],
+            output_names=["head_preds"],
+            dynamic_axes={
+                "decoder_hidden_states": {0: "batch", 1: "length"},
+                "encoder_hidden_states": {0: "batch"},
+                "head_preds": {0: "batch", 1: "length"},
+            },
+            opset_version=opset_version,
+        )
+
+        # the scorer only reads the cross-attention states of the layers before layer_for_head
+        scorer_cross_names = cross_names[: 2 * (model.layer_for_head % (num_layers + 1))]
+        torch.onnx.export(
+            ScorerForOnnx(model),
+            (
+                torch.zeros(batch_size, 5, dtype=torch.long),
+                torch.ones(batch_size, 5, dtype=torch.long),
+                torch.zeros(batch_size, encoder_length, d_model),
+                *cross_key_values[: len(scorer_cross_names)],
+            ),
+            os.path.join(output_dir, ONNX_SCORER_FILENAME),
+            input_names=["input_ids", "attention_mask", "encoder_hidden_states", *scorer_cross_names],
+            output_names=["head_preds"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "length"},
+                "attention_mask": {0: "batch", 1: "length"},
+                "encoder_hidden_states": {0: "batch"},
+                "head_preds": {0: "batch", 1: "length"},
+                **{name: {0: "batch"} for name in scorer_cross_names},
+            },
+            opset_version=opset_version,
+        )
+
+    generation_config = model.whisper_model.generation_config
+    # <|startoftranscript|> followed by the forced tokens (<|notimestamps|> for .en models)
+    decoder_prompt_ids = [generation_config.decoder_start_token_id] + [
+        token for _, token in sorted(generation_config.forced_decoder_ids or [])
+    ]
+    config = {
+        "layer_for_head": model.layer_for_head,
+        "whisper_backbone_name": model.whisper_backbone_name,
+        "num_layers": num_layers,
+        "num_heads": num_heads,
+        "head_dim": head_dim,
+        "decoder_prompt_ids": decoder_prompt_ids,
+        "eos_token_id": generation_config.eos_token_id,
+        "pad_token_id": generation_config.pad_token_id,
+        "suppress_tokens": list(generation_config.suppress_tokens or []),
+        "begin_suppress_tokens": list(generation_config.begin_suppress_tokens or []),
+        "model_fingerprint": model_fingerprint,
+    }
+    with open(os.path.join(output_dir, ONNX_CONFIG_FILENAME), "w") as f:
+        json.dump(config, f, indent=2)
+    model.processor.save_pretrained(output_dir)
@@ -88,8 +88,14 @@ function App() {
       });
       const data = await response.json();
 
-      if (data.success) {
-        pollTaskResult(data.task_id, idx);
+      if (data.success && data.result) {
+        // 快取命中，結果已隨回應一起回傳
+        updateState(idx, {
+          userStressIndices: [...data.result.predicted_stresses],
+          showResult: true,
+        });
+      } else if (data.success) {
+        streamTaskResult(data.task_id, idx);
       } else {
         alert("分析任務提交失敗");
       }
@@ -98,6 +104,27 @@ function App() {
     }
   };
 
+  // 以 Server-Sent Events 等待結果，Worker 完成後立即推送；連線失敗時退回輪詢
+  const streamTaskResult = (taskId, idx) => {
+    const source = new EventSource(`http://localhost:8000/tasks/${taskId}/events`);
+    source.onmessage = (event) => {
+      source.close();
+      const data = JSON.parse(event.data);
+      if (data.status === "COMPLETED") {
+        updateState(idx, {
+          userStressIndices: [...data.result.predicted_stresses],
+          showResult: true,
+        });
+      } else if (data.status === "FAILED") {
+        alert("任務失敗：" + data.error);
+      }
+    };
+    source.onerror = () => {
+      source.close();
+      pollTaskResult(taskId, idx);
+    };
+  };
+
   const pollTaskResult = (taskId, idx) => {
     const interval = setInterval(async () => {
       try {
@@ -107,9 +134,7 @@ function App() {
         if (data.status === "COMPLETED") {
           clearInterval(interval);
 
-          if (data.result.batch_task_id) {
-            pollTaskResult(data.result.batch_task_id, idx);
-          } else if (data.result.predicted_transcription) {
+          if (data.result.predicted_transcription) {
             const predicted = data.result.predicted_stresses;
             updateState(idx, {
               userStressIndices: [...predicted],